@@ -0,0 +1,248 @@
+"""Graphite render API benchmark.
+
+Seeds whisper files following the retentions of storage-schemas.conf and
+replays a mix of dashboard queries against the render API. Progress goes
+to stderr and the results are printed to stdout as JSON.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+
+import whisper
+
+try:
+    from ConfigParser import RawConfigParser
+    from urllib import urlencode
+    from urllib2 import urlopen
+except ImportError:
+    from configparser import RawConfigParser
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+PREFIX = "stats.benchmark.render"
+METRICS = ("cpu", "requests", "errors", "latency")
+
+
+def log(message):
+    print(message, file=sys.stderr)
+    sys.stderr.flush()
+
+
+def match_section(path, metric, option):
+    parser = RawConfigParser()
+    parser.read(path)
+    for section in parser.sections():
+        if re.search(parser.get(section, 'pattern'), metric):
+            if parser.has_option(section, option):
+                return parser, section
+    return parser, None
+
+
+def storage_settings(conf_dir, metric):
+    parser, section = match_section(
+        os.path.join(conf_dir, "storage-schemas.conf"), metric, 'retentions')
+    archives = [whisper.parseRetentionDef(retention.strip()) for retention
+                in parser.get(section, 'retentions').split(",")]
+    parser, section = match_section(
+        os.path.join(conf_dir, "storage-aggregation.conf"), metric,
+        'aggregationMethod')
+    if section is None:
+        return archives, 0.5, "average"
+    return (archives, parser.getfloat(section, 'xFilesFactor'),
+            parser.get(section, 'aggregationMethod'))
+
+
+def value_at(timestamp, series):
+    # A daily wave with some noise, different for every series
+    wave = math.sin(2 * math.pi * (timestamp % 86400) / 86400 + series)
+    return round(50 + 40 * wave + random.uniform(-5, 5), 2)
+
+
+def seed(args):
+    now = int(time.time())
+    created = 0
+    for index in range(args.series):
+        for name in METRICS:
+            metric = "%s.host%d.%s" % (PREFIX, index, name)
+            path = os.path.join(args.whisper_dir, *metric.split(".")) + ".wsp"
+            if os.path.exists(path):
+                continue
+            archives, xff, method = storage_settings(args.conf_dir, metric)
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            whisper.create(path, archives, xff, method)
+            # Fill every archive at its own resolution, so the long ranges
+            # are read from the coarser archives as they would in production
+            newest = now
+            for seconds, points in archives:
+                oldest = now - seconds * points
+                series = [(timestamp, value_at(timestamp, index))
+                          for timestamp in range(newest, oldest, -seconds)]
+                whisper.update_many(path, series)
+                newest = oldest
+            created += 1
+    log("seeded %d whisper files" % created)
+    return created
+
+
+def queries(args):
+    host = random.randint(0, args.series - 1)
+    return {
+        'single': {'target': "%s.host%d.cpu" % (PREFIX, host),
+                   'from': "-1h"},
+        'wildcard': {'target': "%s.*.cpu" % PREFIX, 'from': "-6h"},
+        'sum_series': {'target': "sumSeries(%s.*.requests)" % PREFIX,
+                       'from': "-24h"},
+        'month': {'target': "%s.host%d.*" % (PREFIX, host), 'from': "-30d"},
+        'year': {'target': "averageSeries(%s.*.latency)" % PREFIX,
+                 'from': "-365d"},
+    }
+
+
+def panels(args):
+    return [{'target': "%s.*.%s" % (PREFIX, METRICS[index % len(METRICS)]),
+             'from': "-%dh" % (6 * (1 + index // len(METRICS)))}
+            for index in range(args.panels)]
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.cache = {}
+
+    def request(self, args, scenario, params):
+        params = dict(params, format="json", maxDataPoints=1000)
+        if not args.cache:
+            params.update({'noCache': "true", '_': random.random()})
+        start = time.time()
+        try:
+            response = urlopen(args.url, urlencode(params).encode(),
+                               timeout=args.request_timeout)
+            response.read()
+            status = response.info().get("X-Cache-Status", "NONE")
+            error = False
+        except Exception:
+            status = "ERROR"
+            error = True
+        latency = time.time() - start
+        with self.lock:
+            self.latencies.setdefault(scenario, []).append(latency)
+            self.errors[scenario] = self.errors.get(scenario, 0) + error
+            self.cache[status] = self.cache.get(status, 0) + 1
+        return latency
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(math.ceil(fraction * len(values))) - 1, len(values) - 1)
+    return round(values[max(index, 0)] * 1000, 1)
+
+
+def summary(latencies, errors, seconds):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / seconds, 1) if seconds else 0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def query_worker(args, recorder, deadline):
+    while time.time() < deadline:
+        scenario, params = random.choice(sorted(queries(args).items()))
+        recorder.request(args, scenario, params)
+
+
+def dashboard_load(args, recorder, loads):
+    # Grafana fires every panel of a dashboard at the same time
+    start = time.time()
+    threads = [threading.Thread(target=recorder.request,
+                                args=(args, "panel", params))
+               for params in panels(args)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    loads.append(time.time() - start)
+
+
+def burst_worker(args, recorder, deadline, loads):
+    while time.time() < deadline:
+        dashboard_load(args, recorder, loads)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080/render")
+    parser.add_argument("--series", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--dashboards", type=int, default=2)
+    parser.add_argument("--panels", type=int, default=12)
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--request-timeout", type=int, default=30)
+    parser.add_argument("--no-cache", dest="cache", action="store_false")
+    parser.add_argument("--whisper-dir", required=True)
+    parser.add_argument("--conf-dir", required=True)
+    parser.add_argument("--cleanup", action="store_true")
+    args = parser.parse_args()
+
+    seeded = seed(args)
+    log("replaying queries with %d clients and %d dashboards for %ds" % (
+        args.concurrency, args.dashboards, args.duration))
+    recorder = Recorder()
+    loads = []
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=query_worker,
+                                args=(args, recorder, deadline))
+               for _ in range(args.concurrency)]
+    threads += [threading.Thread(target=burst_worker,
+                                 args=(args, recorder, deadline, loads))
+                for _ in range(args.dashboards)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    scenarios = dict(
+        (scenario, summary(latencies, recorder.errors[scenario], seconds))
+        for scenario, latencies in recorder.latencies.items())
+    every = [latency for latencies in recorder.latencies.values()
+             for latency in latencies]
+    total = summary(every, sum(recorder.errors.values()), seconds)
+    dashboards = summary(loads, 0, seconds)
+    del dashboards['errors']
+
+    if args.cleanup:
+        shutil.rmtree(os.path.join(args.whisper_dir, *PREFIX.split(".")))
+
+    print(json.dumps({
+        'seeded_files': seeded,
+        'seconds': round(seconds, 3),
+        'total': total,
+        'scenarios': scenarios,
+        'dashboards': dashboards,
+        'cache_status': recorder.cache,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Sentry event ingestion benchmark.
+
+Posts synthetic events to the store endpoint at increasing rates, while
+sampling the depth of the celery queues in Redis and the time the workers
+take to save the events, until the stack can't keep up. It runs on the
+Sentry virtualenv with SENTRY_CONF set, progress goes to stderr and the
+results are printed to stdout as JSON.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from sentry.runner import configure
+configure()
+
+from django.conf import settings
+from sentry.models import (Event, Organization, Project, ProjectKey,
+                           Team)
+
+import redis
+
+try:
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+try:
+    import ssl
+    SSL_CONTEXT = ssl._create_unverified_context()
+except (ImportError, AttributeError):
+    SSL_CONTEXT = None
+
+
+def log(message):
+    print(message, file=sys.stderr)
+    sys.stderr.flush()
+
+
+def benchmark_project():
+    organization = Organization.objects.order_by('id')[0]
+    team, _ = Team.objects.get_or_create(
+        organization=organization, slug="benchmark",
+        defaults={'name': "Benchmark"})
+    project, _ = Project.objects.get_or_create(
+        organization=organization, team=team, slug="benchmark",
+        defaults={'name': "Benchmark"})
+    key = ProjectKey.objects.filter(project=project).first()
+    if key is None:
+        key = ProjectKey.objects.create(project=project)
+    return project, key
+
+
+def make_event(args, issue):
+    # Every issue has its own stack trace so the events are spread over
+    # several groups, and the variables pad the payload to a random size
+    depth = 5 + issue % 30
+    padding = random.randint(args.min_kb, args.max_kb) * 1024 // depth
+    frames = [{
+        'filename': "app/module%d.py" % ((issue * 7 + index) % 50),
+        'module': "app.module%d" % ((issue * 7 + index) % 50),
+        'function': "handler_%d_%d" % (issue, index),
+        'lineno': 10 + index,
+        'in_app': True,
+        'context_line': "    result = process(item)",
+        'vars': {'item': "x" * padding},
+    } for index in range(depth)]
+    return {
+        'event_id': uuid.uuid4().hex,
+        'message': "Benchmark error %d" % issue,
+        'culprit': "app.module%d" % issue,
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+        'level': "error",
+        'platform': "python",
+        'exception': {'values': [{
+            'type': "BenchmarkError%d" % issue,
+            'value': "Synthetic event",
+            'stacktrace': {'frames': frames},
+        }]},
+    }
+
+
+class Sender(object):
+
+    def __init__(self, args, project, key):
+        self.args = args
+        self.url = "%s/api/%d/store/" % (args.url, project.id)
+        self.headers = {
+            'Content-Type': "application/json",
+            'X-Sentry-Auth': "Sentry sentry_version=7, "
+                             "sentry_client=devops-benchmark/1.0, "
+                             "sentry_key=%s, sentry_secret=%s" % (
+                                 key.public_key, key.secret_key),
+        }
+        if args.host_header:
+            self.headers['Host'] = args.host_header
+        self.lock = threading.Lock()
+        self.accepted = self.rejected = self.failed = 0
+        self.probes = {}
+
+    def send(self, probe=False):
+        event = make_event(self.args, random.randint(0, self.args.issues - 1))
+        request = Request(self.url, json.dumps(event).encode(), self.headers)
+        sent_at = time.time()
+        try:
+            kwargs = {'timeout': 10}
+            if SSL_CONTEXT and self.url.startswith("https"):
+                kwargs['context'] = SSL_CONTEXT
+            urlopen(request, **kwargs).read()
+            status = "accepted"
+        except HTTPError as e:
+            status = "rejected" if e.code == 429 else "failed"
+        except Exception:
+            status = "failed"
+        with self.lock:
+            setattr(self, status, getattr(self, status) + 1)
+            if probe and status == "accepted":
+                self.probes[event['event_id']] = sent_at
+
+    def counts(self):
+        with self.lock:
+            return self.accepted, self.rejected, self.failed
+
+
+def client(sender, rate, deadline):
+    interval = 1.0 / rate
+    next_send = time.time()
+    last_probe = 0
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if now < next_send:
+            time.sleep(min(next_send - now, 0.01))
+            continue
+        # One event per second is followed until a worker saves it
+        probe = now - last_probe >= 1
+        if probe:
+            last_probe = now
+        sender.send(probe)
+        next_send += interval
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, project, sender):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.project = project
+        self.sender = sender
+        self.redis = redis.StrictRedis.from_url(settings.BROKER_URL)
+        self.queues = [queue.name for queue in settings.CELERY_QUEUES]
+        self.lock = threading.Lock()
+        self.depths = []
+        self.lags = []
+
+    def depth(self):
+        pipeline = self.redis.pipeline()
+        for name in self.queues:
+            pipeline.llen(name)
+        return sum(pipeline.execute())
+
+    def saved_probes(self):
+        with self.sender.lock:
+            pending = dict(self.sender.probes)
+        if not pending:
+            return
+        saved = Event.objects.filter(
+            project_id=self.project.id, event_id__in=list(pending),
+        ).values_list('event_id', flat=True)
+        now = time.time()
+        with self.sender.lock:
+            for event_id in saved:
+                self.sender.probes.pop(event_id, None)
+        with self.lock:
+            self.lags.extend(now - pending[event_id] for event_id in saved)
+
+    def run(self):
+        while True:
+            depth = self.depth()
+            with self.lock:
+                self.depths.append((time.time(), depth))
+            self.saved_probes()
+            time.sleep(1)
+
+    def take(self):
+        with self.lock:
+            depths, lags = self.depths, self.lags
+            self.depths, self.lags = [], []
+        return depths, lags
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return round(values[min(int(fraction * len(values)),
+                            len(values) - 1)], 3)
+
+
+def run_step(args, project, sender, sampler, rate):
+    counts = sender.counts()
+    saved = Event.objects.filter(project_id=project.id).count()
+    start = time.time()
+    deadline = start + args.step_duration
+    clients = min(args.clients, rate)
+    threads = [threading.Thread(target=client,
+                                args=(sender, rate / clients, deadline))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    accepted, rejected, failed = [
+        after - before for after, before in zip(sender.counts(), counts)]
+    processed = Event.objects.filter(project_id=project.id).count() - saved
+    depths, lags = sampler.take()
+    growth = 0
+    if len(depths) > 1:
+        growth = ((depths[-1][1] - depths[0][1]) /
+                  max(depths[-1][0] - depths[0][0], 1))
+    step = {
+        'rate': rate,
+        'accepted_per_second': round(accepted / seconds, 1),
+        'processed_per_second': round(processed / seconds, 1),
+        'rejected': rejected,
+        'failed': failed,
+        'queue_depth_max': max([depth for _, depth in depths] or [0]),
+        'queue_growth_per_second': round(growth, 1),
+        'worker_lag_p50': percentile(lags, 0.50),
+        'worker_lag_p95': percentile(lags, 0.95),
+    }
+    # The stack keeps up while the endpoint accepts the events and the
+    # workers drain the queues as fast as they are filled
+    sent = accepted + rejected + failed
+    step['sustained'] = (
+        accepted >= 0.95 * rate * seconds and
+        (rejected + failed) <= 0.01 * max(sent, 1) and
+        growth <= 0.05 * rate)
+    log("%(rate)d events/s: %(accepted_per_second).1f accepted, "
+        "%(processed_per_second).1f processed, queue growing "
+        "%(queue_growth_per_second).1f/s" % step)
+    return step
+
+
+def drain(args, sampler):
+    start = time.time()
+    while time.time() - start < args.drain_timeout:
+        if sampler.depth() == 0:
+            return round(time.time() - start, 1)
+        time.sleep(1)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:9000")
+    parser.add_argument("--host-header", default="")
+    parser.add_argument("--start-rate", type=int, default=10)
+    parser.add_argument("--step", type=int, default=10)
+    parser.add_argument("--max-rate", type=int, default=500)
+    parser.add_argument("--step-duration", type=int, default=30)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--issues", type=int, default=50)
+    parser.add_argument("--min-kb", type=int, default=1)
+    parser.add_argument("--max-kb", type=int, default=20)
+    parser.add_argument("--drain-timeout", type=int, default=300)
+    args = parser.parse_args()
+
+    project, key = benchmark_project()
+    sender = Sender(args, project, key)
+    sampler = Sampler(project, sender)
+    sampler.start()
+    steps = []
+    saturation = None
+    for rate in range(args.start_rate, args.max_rate + 1, args.step):
+        step = run_step(args, project, sender, sampler, rate)
+        steps.append(step)
+        if not step['sustained']:
+            saturation = rate
+            break
+    sustained = [step['processed_per_second'] for step in steps
+                 if step['sustained']]
+
+    print(json.dumps({
+        'project': project.slug,
+        'queues': sampler.queues,
+        'steps': steps,
+        'sustained_throughput': max(sustained or [0]),
+        'saturation_rate': saturation,
+        'drain_seconds': drain(args, sampler),
+    }))
+
+
+if __name__ == "__main__":
+    main()
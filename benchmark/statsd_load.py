@@ -0,0 +1,223 @@
+"""Statsd ingestion benchmark.
+
+Fires counters, timers and gauges at statsd for a while, then follows the
+metrics through carbon down to the whisper files. The metrics are created
+by a warm-up pass before the measurement, so carbon's MAX_CREATES_PER_MINUTE
+doesn't count as dropped points. Progress goes to stderr and the results
+are printed to stdout as JSON.
+"""
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import time
+
+import whisper
+
+
+def log(message):
+    print(message, file=sys.stderr)
+    sys.stderr.flush()
+
+
+def send_load(args, prefix):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    counters = [0] * args.keys
+    sent = errors = 0
+    interval = 1.0 / args.rate
+    start = time.time()
+    deadline = start + args.duration
+    next_send = start
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if now < next_send:
+            time.sleep(min(next_send - now, 0.01))
+            continue
+        key = sent % args.keys
+        kind = (sent // args.keys) % 3
+        if kind == 0:
+            packet = "%s.counters.k%d:1|c" % (prefix, key)
+        elif kind == 1:
+            packet = "%s.timers.k%d:%d|ms" % (prefix, key,
+                                             random.randint(1, 1000))
+        else:
+            packet = "%s.gauges.k%d:%d|g" % (prefix, key,
+                                            random.randint(0, 100))
+        try:
+            sock.sendto(packet.encode(), (args.host, args.port))
+            if kind == 0:
+                counters[key] += 1
+        except socket.error:
+            errors += 1
+        sent += 1
+        next_send += interval
+    elapsed = time.time() - start
+    return {
+        'sent': sent,
+        'send_errors': errors,
+        'seconds': round(elapsed, 3),
+        'achieved_rate': round(sent / elapsed, 1),
+    }, counters
+
+
+def whisper_path(whisper_dir, metric):
+    return os.path.join(whisper_dir, *metric.split(".")) + ".wsp"
+
+
+def warm_up(args, prefix):
+    # Zero increments create the counter files without adding to the sums
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    paths = [whisper_path(args.whisper_dir,
+                          "stats.counters.%s.counters.k%d.count" % (prefix,
+                                                                    key))
+             for key in range(args.keys)]
+    # The prefix is kept between runs, so the files are only created once
+    deadline = time.time() + args.warmup_timeout
+    while time.time() < deadline:
+        missing = [key for key, path in enumerate(paths)
+                   if not os.path.exists(path)]
+        if not missing:
+            break
+        log("warming up, %d of %d keys not created yet" % (len(missing),
+                                                           args.keys))
+        for key in missing:
+            for packet in ("%s.counters.k%d:0|c" % (prefix, key),
+                           "%s.timers.k%d:0|ms" % (prefix, key),
+                           "%s.gauges.k%d:0|g" % (prefix, key)):
+                try:
+                    sock.sendto(packet.encode(), (args.host, args.port))
+                except socket.error:
+                    pass
+        time.sleep(10)
+    return len(paths) - sum(1 for path in paths if os.path.exists(path))
+
+
+def fetch_sum(path, start, end):
+    if not os.path.exists(path):
+        return None
+    (_, _, _), values = whisper.fetch(path, int(start), int(end) + 1)
+    return sum(value for value in values if value is not None)
+
+
+def received_counters(args, prefix, start, end):
+    received = []
+    for key in range(args.keys):
+        metric = "stats.counters.%s.counters.k%d.count" % (prefix, key)
+        received.append(fetch_sum(whisper_path(args.whisper_dir, metric),
+                                  start, end))
+    return received
+
+
+def wait_for_flush(args, prefix, counters, start, end):
+    # Statsd flushes every ten seconds and carbon may hold the points in its
+    # cache for a while, so poll the whisper files until every counter has
+    # been written or the totals stop moving.
+    expected = sum(counters)
+    total = previous = None
+    settled_at = time.time()
+    while time.time() - end < args.timeout:
+        received = received_counters(args, prefix, start, time.time())
+        total = sum(value or 0 for value in received)
+        if total != previous:
+            settled_at = time.time()
+            previous = total
+            log("received %d of %d counter increments" % (total, expected))
+        if total >= expected:
+            break
+        if previous and time.time() - settled_at > 30:
+            break
+        time.sleep(1)
+    missing = sum(1 for value in received if value is None)
+    return {
+        'expected_counts': expected,
+        'received_counts': int(total or 0),
+        'drop_rate': round(1 - (total or 0) / expected, 4) if expected else 0,
+        'missing_keys': missing,
+        'flush_latency': round(max(settled_at - end, 0), 3),
+    }
+
+
+def carbon_agents(args, start, end):
+    agents = {}
+    pattern = os.path.join(args.whisper_dir, "carbon", "agents", "*")
+    for agent_dir in sorted(glob.glob(pattern)):
+        agent = {}
+        for name in ("metricsReceived", "committedPoints", "updateOperations",
+                     "creates", "droppedCreates", "cache/overflow",
+                     "cache/queues"):
+            value = fetch_sum(os.path.join(agent_dir, name + ".wsp"),
+                              start, end)
+            if value is not None:
+                agent[name.replace("/", ".")] = value
+        path = os.path.join(agent_dir, "cache", "size.wsp")
+        if os.path.exists(path):
+            _, values = whisper.fetch(path, int(start), int(end) + 1)
+            agent['cache.size.max'] = max(
+                [value for value in values if value is not None] or [0])
+        agents[os.path.basename(agent_dir)] = agent
+    return agents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8125)
+    parser.add_argument("--rate", type=int, default=1000)
+    parser.add_argument("--keys", type=int, default=100)
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--timeout", type=int, default=180)
+    parser.add_argument("--warmup-timeout", type=int, default=1800)
+    parser.add_argument("--whisper-dir", required=True)
+    parser.add_argument("--prefix", default="benchmark.ingest")
+    parser.add_argument("--cleanup", action="store_true")
+    args = parser.parse_args()
+
+    prefix = args.prefix
+    not_created = warm_up(args, prefix)
+    log("sending %d metrics/s over %d keys for %ds" % (
+        args.rate, args.keys, args.duration))
+    start = time.time()
+    load, counters = send_load(args, prefix)
+    end = time.time()
+    ingest = wait_for_flush(args, prefix, counters, start - 10, end)
+
+    # Carbon reports its own metrics once a minute, so wait for the interval
+    # covering the end of the load before reading them.
+    agents_until = end + 60 - end % 60 + 5
+    while time.time() < min(agents_until, end + args.timeout):
+        time.sleep(1)
+    agents = carbon_agents(args, start - 60, time.time())
+    committed = sum(agent.get('committedPoints', 0)
+                    for agent in agents.values())
+    window = time.time() - start + 60
+    ingest['points_per_second'] = round(committed / window, 1)
+    # Reported apart from the drop rate, which only counts the points of
+    # metrics that were already created
+    ingest['not_created_keys'] = not_created
+    ingest['dropped_creates'] = sum(agent.get('droppedCreates', 0)
+                                    for agent in agents.values())
+
+    if args.cleanup:
+        pattern = os.path.join(args.whisper_dir, "stats", "*",
+                               *prefix.split("."))
+        for path in glob.glob(pattern):
+            shutil.rmtree(path)
+
+    print(json.dumps({
+        'prefix': prefix,
+        'load': load,
+        'ingest': ingest,
+        'carbon_agents': agents,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+from fabric.api import run, sudo, get, put, env
+from common import batch
+
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+platforms = {}
+
+
+def enabled():
+    return bool(env.get('artifact_cache'))
+
+
+def cache_path(*parts):
+    return os.path.join(os.path.expanduser(env.artifact_cache), *parts)
+
+
+def platform():
+    if env.host_string not in platforms:
+        platforms[env.host_string] = "-".join(
+            run("lsb_release -cs && uname -m").split())
+    return platforms[env.host_string]
+
+
+def file_digest(path, algorithm='sha256'):
+    sha = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def wheel_requirements(path):
+    # pip wheel builds the VCS requirements into wheels named after their
+    # egg, so the wheelhouse installs them by name without cloning again
+    lines = []
+    with open(path) as f:
+        for line in f.read().splitlines():
+            if "://" in line and "#egg=" in line:
+                line = line.split("#egg=", 1)[1].split("&", 1)[0]
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def index_path(key):
+    digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    return cache_path("index", "%s-%s" % (key[0], digest[:16]))
+
+
+def write_atomic(path, write):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temporary = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        write(f)
+    os.rename(temporary, path)
+
+
+def lookup(key):
+    if not enabled() or not os.path.exists(index_path(key)):
+        return None
+    entries = []
+    with open(index_path(key)) as f:
+        for line in f.read().splitlines():
+            digest, name = line.split(None, 1)
+            entries.append((name, digest, cache_path("objects", digest)))
+    return entries
+
+
+def store(key, paths):
+    lines = []
+    for path in sorted(paths):
+        digest = file_digest(path)
+        target = cache_path("objects", digest)
+        if not os.path.exists(target):
+            with open(path, 'rb') as source:
+                write_atomic(target,
+                             lambda f: shutil.copyfileobj(source, f))
+        lines.append("%s %s\n" % (digest, os.path.basename(path)))
+    write_atomic(index_path(key),
+                 lambda f: f.write("".join(lines).encode()))
+
+
+def download(key, url):
+    if not enabled():
+        return False
+    if lookup(key) is None:
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, url.rsplit("/", 1)[-1])
+            response = urlopen(url)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            store(key, [path])
+        finally:
+            shutil.rmtree(directory)
+    return True
+
+
+def push(key, remote_dir, use_sudo=False):
+    entries = lookup(key)
+    if entries is None:
+        return False
+    names = " ".join(name for name, digest, path in entries)
+    command = "cd %s 2>/dev/null && sha256sum %s 2>/dev/null || true" % (
+        remote_dir, names)
+    remote = (sudo if use_sudo else run)(command)
+    present = set(tuple(line.split()) for line in remote.splitlines())
+    missing = [(name, path) for name, digest, path in entries
+               if (digest, name) not in present]
+    if not missing:
+        return True
+
+    handle, archive = tempfile.mkstemp(suffix=".tar")
+    os.close(handle)
+    try:
+        with tarfile.open(archive, 'w') as tar:
+            for name, path in missing:
+                tar.add(path, arcname=name)
+        remote_archive = "/tmp/devops-artifacts-%s.tar" % file_digest(archive)
+        put(archive, remote_archive)
+    finally:
+        os.remove(archive)
+    with batch.Batch() as commands:
+        install = (commands.sudo if use_sudo else commands.run)
+        install("mkdir -p %(dir)s && tar xf %(archive)s -C %(dir)s" % {
+            'dir': remote_dir, 'archive': remote_archive})
+        commands.run("rm -f %s" % remote_archive)
+    return True
+
+
+def fetch(key, remote_dir, pattern):
+    if not enabled() or lookup(key) is not None:
+        return
+    remote_archive = "/tmp/devops-artifacts-%s.tar" % os.path.basename(
+        index_path(key))
+    # Nothing to store when there are no new files, e.g. apt had all the
+    # packages already
+    if not run("cd %s && ls %s 2>/dev/null || true" % (remote_dir, pattern)):
+        return
+    run("cd %s && tar cf %s %s" % (remote_dir, remote_archive, pattern))
+    directory = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(directory, "artifacts.tar")
+        get(remote_archive, archive)
+        run("rm -f %s" % remote_archive)
+        with tarfile.open(archive) as tar:
+            members = [member for member in tar.getmembers()
+                       if member.isfile() and "/" not in member.name]
+            tar.extractall(os.path.join(directory, "files"), members)
+        store(key, [os.path.join(directory, "files", member.name)
+                    for member in members])
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,78 @@
+from fabric.api import run, sudo, env, settings
+from fabric.utils import abort
+
+import base64
+import re
+
+try:
+    from pipes import quote
+except ImportError:
+    from shlex import quote
+
+MARKER = "__batch__"
+
+
+class Batch(object):
+
+    def __init__(self):
+        self.commands = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def run(self, command):
+        self.commands.append((command, None, False))
+
+    def sudo(self, command, user=None):
+        self.commands.append((command, user, True))
+
+    def script(self, use_sudo):
+        lines = []
+        for index, (command, user, as_sudo) in enumerate(self.commands):
+            if use_sudo and not as_sudo:
+                user = env.user
+            if user:
+                command = 'sudo -u %s -H env PATH="$PATH" bash -c %s' % (
+                    user, quote(command))
+            lines.append("echo %s start %d" % (MARKER, index))
+            lines.append(command)
+            lines.append("rc=$?; echo %s end %d $rc; "
+                         "[ $rc -eq 0 ] || exit $rc" % (MARKER, index))
+        return "\n".join(lines) + "\n"
+
+    def execute(self):
+        if not self.commands:
+            return []
+        use_sudo = any(as_sudo for command, user, as_sudo in self.commands)
+        payload = base64.b64encode(self.script(use_sudo).encode()).decode()
+        command = ("f=$(mktemp) && echo %s | base64 -d > $f && bash $f; "
+                   "rc=$?; rm -f $f; exit $rc" % payload)
+        with settings(warn_only=True):
+            if use_sudo:
+                result = sudo(command)
+            else:
+                result = run(command)
+        self.results = self.parse(result)
+        if result.failed:
+            index = len(self.results) - 1
+            if index < 0:
+                abort(result)
+            abort("Command failed: %s\n\n%s" % (
+                self.commands[index][0], self.results[index]))
+        del self.commands[:]
+        return self.results
+
+    def parse(self, output):
+        results = []
+        for line in output.splitlines():
+            match = re.match(r"%s (start|end) (\d+)" % MARKER, line.strip())
+            if match and match.group(1) == "start":
+                results.append([])
+            elif not match and results:
+                results[-1].append(line)
+        return ["\n".join(lines) for lines in results]
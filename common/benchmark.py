@@ -0,0 +1,42 @@
+from __future__ import print_function
+
+from fabric.api import run, sudo, env, put
+
+import datetime
+import json
+import os
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "benchmark")
+
+
+def run_script(name, arguments, python="python", use_sudo=False):
+    remote = "/tmp/devops-benchmark-" + name
+    put(os.path.join(SCRIPTS_DIR, name), remote)
+    command = " ".join([python, remote] + list(arguments))
+    if use_sudo:
+        output = sudo(command, combine_stderr=False)
+    else:
+        output = run(command, combine_stderr=False)
+    run("rm -f " + remote)
+    return json.loads(output.splitlines()[-1])
+
+
+def write_report(name, parameters, results):
+    # Reports share the same layout so runs on different hosts or versions
+    # can be compared directly.
+    now = datetime.datetime.utcnow()
+    report = {
+        'benchmark': name,
+        'host': env.host_string,
+        'date': now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'parameters': parameters,
+        'results': results,
+    }
+    directory = os.path.expanduser(env.benchmark_reports)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "%s-%s-%s.json" % (
+        name, env.host.replace(":", "_"), now.strftime("%Y%m%d%H%M%S")))
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
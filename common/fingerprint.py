@@ -0,0 +1,69 @@
+from __future__ import print_function
+
+from fabric.api import run, env
+from fabric.colors import yellow
+from functools import wraps
+
+import glob
+import hashlib
+import json
+
+STATE_DIR = "~/.devops-state"
+
+
+def print_skip():
+    print("[", end="")
+    print(yellow("Skip"), end="")
+    print("]")
+
+
+def forced():
+    return str(env.get('force', '')).lower() in ('1', 'true', 'yes')
+
+
+def files(*patterns):
+    def read():
+        contents = {}
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)):
+                with open(path, 'rb') as f:
+                    contents[path] = hashlib.sha1(f.read()).hexdigest()
+        return contents
+    return read
+
+
+def digest(inputs):
+    sha = hashlib.sha1()
+    for value in inputs:
+        if callable(value):
+            value = value()
+        sha.update(json.dumps(value, sort_keys=True, default=repr).encode())
+    return sha.hexdigest()
+
+
+def state_path(name):
+    return "%s/%s.%s" % (STATE_DIR, env.component, name)
+
+
+def track(*inputs):
+    def decorator(task):
+        @wraps(task)
+        def wrapper(*args, **kwargs):
+            path = state_path(task.__name__)
+            current = digest((task.__name__,) + inputs)
+            if not forced():
+                recorded = run("cat %s 2>/dev/null || true" % path)
+                if recorded.strip() == current:
+                    print("%s is up to date..." % task.__name__, end="\t")
+                    print_skip()
+                    env.step_unchanged = True
+                    return
+            failed = env.get('step_failed', False)
+            env.step_failed = False
+            result = task(*args, **kwargs)
+            if not env.step_failed:
+                run("mkdir -p %s && echo %s > %s" % (STATE_DIR, current, path))
+            env.step_failed = failed or env.step_failed
+            return result
+        return wrapper
+    return decorator
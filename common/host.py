@@ -0,0 +1,53 @@
+from fabric.api import run, env, settings
+
+import json
+import re
+
+facts = {}
+
+
+def host_facts():
+    if env.host_string not in facts:
+        output = run("nproc && awk '/^MemTotal/ {print $2}' /proc/meminfo")
+        cores, memory = output.split()
+        facts[env.host_string] = {
+            'cores': int(cores),
+            'memory_mb': int(memory) // 1024,
+        }
+    return facts[env.host_string]
+
+
+def cores():
+    return host_facts()['cores']
+
+
+def memory_mb():
+    return host_facts()['memory_mb']
+
+
+def disk_iops(path):
+    # Random 4k synchronous writes, the access pattern of whisper updates.
+    # The result is kept on the host so the probe only runs once.
+    cache = "~/.devops-state/iops-%s" % re.sub(r"\W", "_", path)
+    cached = run("cat %s 2>/dev/null || true" % cache).strip()
+    if cached:
+        return int(cached)
+    probe = "%s/.iops-probe" % path
+    with settings(warn_only=True):
+        # The report goes to its own file, the warnings fio prints would
+        # break the JSON
+        output = run("fio --name=probe --filename=%s --size=64M "
+                     "--rw=randwrite --bs=4k --direct=1 --ioengine=libaio "
+                     "--iodepth=16 --runtime=5 --time_based "
+                     "--output-format=json --output=%s.json && cat %s.json" % (
+                         probe, probe, probe), combine_stderr=False)
+    if output.succeeded:
+        iops = int(json.loads(output)['jobs'][0]['write']['iops'])
+    else:
+        output = run("LC_ALL=C dd if=/dev/zero of=%s bs=4k count=2000 "
+                     "oflag=direct,dsync 2>&1" % probe)
+        seconds = float(re.search(r"copied, ([\d.]+) s", output).group(1))
+        iops = int(2000 / max(seconds, 0.001))
+    run("rm -f %s %s.json && mkdir -p ~/.devops-state && echo %d > %s" % (
+        probe, probe, iops, cache))
+    return iops
@@ -0,0 +1,63 @@
+from fabric.api import run, sudo
+from fabric.contrib import files
+from common import batch, templates
+
+CLIENT = "/opt/letsencrypt/letsencrypt-auto"
+WEBROOT = "/opt/letsencrypt"
+CHALLENGE_SITE = "/etc/nginx/sites-available/00-acme-challenge"
+
+# Reload nginx gracefully, or start it if it isn't running
+RELOAD_NGINX = "nginx -t && (nginx -s reload || service nginx start)"
+
+
+def certificate_path(domain):
+    return "/etc/letsencrypt/live/%s/fullchain.pem" % domain
+
+
+def exists(domain):
+    return files.exists(certificate_path(domain), use_sudo=True)
+
+
+def issue(domain, email):
+    # The challenges are answered by the running nginx from the webroot,
+    # through a temporary site in case the site of the domain isn't enabled
+    if not files.exists(CLIENT):
+        sudo("git clone https://github.com/letsencrypt/letsencrypt " +
+             WEBROOT)
+    challenge = templates.Template(
+        "../conf/nginx/acme-challenge", CHALLENGE_SITE,
+        context={'server_name': domain, 'webroot': WEBROOT},
+    )
+    templates.upload([challenge])
+    try:
+        with batch.Batch() as commands:
+            commands.sudo(templates.enable(challenge))
+            commands.sudo(RELOAD_NGINX)
+        run("%(client)s certonly --non-interactive --agree-tos --webroot "
+            "-w %(webroot)s --email %(email)s -d %(domain)s" % {
+                'client': CLIENT,
+                'webroot': WEBROOT,
+                'email': email,
+                'domain': domain,
+            })
+    finally:
+        with batch.Batch() as commands:
+            commands.sudo("rm -f %s /etc/nginx/sites-enabled/%s" % (
+                CHALLENGE_SITE, CHALLENGE_SITE.split("/")[-1]))
+            commands.sudo(RELOAD_NGINX)
+
+
+def install_renewal():
+    # A single job renews the certificates of every component, replacing
+    # the renewal scripts and crontabs each component used to install
+    templates.upload([templates.Template(
+        "../conf/letsencrypt/renew-cron",
+        "/etc/cron.d/letsencrypt-renew",
+        context={'client': CLIENT, 'webroot': WEBROOT},
+        mode="644",
+    )])
+    with batch.Batch() as commands:
+        commands.run("crontab -l 2>/dev/null | grep -v 'letsencrypt/.*-renew'"
+                     " | crontab - || true")
+        commands.sudo("rm -f %(dir)s/*-renew.ini %(dir)s/*-renew.sh "
+                      "%(dir)s/*-crontab" % {'dir': WEBROOT})
@@ -0,0 +1,72 @@
+from fabric.api import run, env
+from common import templates
+
+import re
+
+versions = {}
+
+
+def version():
+    if env.host_string not in versions:
+        output = run("nginx -v 2>&1 || true")
+        match = re.search(r"nginx/([\d.]+)", output)
+        versions[env.host_string] = tuple(
+            int(part) for part in match.group(1).split(".")) if match else ()
+    return versions[env.host_string]
+
+
+def ssl_listen(options):
+    # The nginx of Ubuntu 14.04 (1.4.6) doesn't know http2
+    if options.get('http2') and version() >= (1, 9, 5):
+        return "443 ssl http2"
+    return "443 ssl"
+
+
+def ssl_params(options):
+    lines = []
+    if options.get('session_cache'):
+        lines += [
+            "ssl_session_cache shared:SSL:%s;" % options['session_cache'],
+            "ssl_session_timeout %s;" % options.get('session_timeout', "1h"),
+        ]
+    lines.append("ssl_session_tickets %s;" % (
+        "on" if options.get('session_tickets') else "off"))
+    if options.get('stapling'):
+        lines += [
+            "ssl_stapling on;",
+            "resolver %s valid=300s;" % options.get('resolver', "8.8.8.8"),
+            "resolver_timeout 5s;",
+        ]
+    return templates.Template(
+        "../conf/nginx/ssl-params",
+        "/etc/nginx/conf.d/ssl-params.conf",
+        context={'options': "\n".join(lines)},
+    )
+
+
+def proxy_params(options):
+    return templates.Template(
+        "../conf/nginx/proxy-params",
+        "/etc/nginx/proxy-params.conf",
+        context={
+            'buffer_size': options['buffer_size'],
+            'buffers': options['buffers'],
+        },
+    )
+
+
+def static_params(expires):
+    return templates.Template(
+        "../conf/nginx/static-params",
+        "/etc/nginx/static-params.conf",
+        context={'expires': expires},
+    )
+
+
+def precompress(path):
+    # gzip_static serves the .gz next to each file, so write one for every
+    # text asset and keep the original for clients without gzip
+    patterns = " -o ".join("-name '*.%s'" % extension for extension in
+                           ("css", "js", "map", "svg", "html", "json", "txt"))
+    return ("find %s -type f \\( %s \\) -exec sh -c "
+            "'gzip -9 -c \"$0\" > \"$0.gz\"' {} \\;" % (path, patterns))
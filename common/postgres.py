@@ -0,0 +1,146 @@
+from fabric.api import run, env
+from common import fingerprint, host, templates
+
+import hashlib
+
+USER = "dashboard"
+PASSWORD = "dashboard"
+
+# The databases pgbouncer pools, and the extra server connections each pool
+# can open under load
+DATABASES = ("graphite", "grafana", "sentry")
+RESERVE_POOL_SIZE = 5
+
+versions = {}
+
+
+def enabled_pgbouncer():
+    return bool(env.get('pgbouncer'))
+
+
+def version():
+    if env.host_string not in versions:
+        versions[env.host_string] = run(
+            "ls /etc/postgresql | sort -V | tail -n 1").strip()
+    return versions[env.host_string]
+
+
+def conf_dir():
+    return "/etc/postgresql/%s/main" % version()
+
+
+def connection():
+    return {
+        'db_host': "127.0.0.1",
+        'db_port': 6432 if enabled_pgbouncer() else 5432,
+    }
+
+
+def pool_size():
+    return max(10, 2 * host.cores())
+
+
+def clients():
+    # Server connections of the applications. Several components may share
+    # the cluster, so each one records its own on the host and the cluster
+    # is sized for all of them
+    if enabled_pgbouncer():
+        connections = len(DATABASES) * (pool_size() + RESERVE_POOL_SIZE)
+    else:
+        connections = env.postgres_clients()
+    output = run("mkdir -p %(dir)s && echo %(connections)d > %(path)s && "
+                 "cat %(dir)s/*.postgres-clients" % {
+                     'dir': fingerprint.STATE_DIR,
+                     'connections': connections,
+                     'path': fingerprint.state_path("postgres-clients"),
+                 })
+    return sum(int(line) for line in output.split())
+
+
+def tuning():
+    # The cluster shares the host with the applications, so it gets half of
+    # the RAM unless the memory is set
+    memory = env.get('postgres_memory') or host.memory_mb() // 2
+    # Room for psql, the backups and the superuser reserved connections
+    max_connections = max(100, clients() + 20)
+    shared_buffers = memory // 4
+    context = {
+        'max_connections': max_connections,
+        'shared_buffers': shared_buffers,
+        'effective_cache_size': memory,
+        'work_mem': max(4, (memory - shared_buffers) // max_connections // 2),
+        'maintenance_work_mem': max(64, min(memory // 16, 1024)),
+    }
+    # Bigger hosts take more WAL between checkpoints. The WAL size is
+    # configured with checkpoint_segments before 9.5
+    wal_size = max(512, min(memory // 4, 4096))
+    major = tuple(int(part) for part in version().split("."))
+    if major < (9, 5):
+        context['checkpoint_size'] = "checkpoint_segments = %d" % (
+            wal_size // 16 // 3)
+    else:
+        context['checkpoint_size'] = ("min_wal_size = 80MB\n"
+                                      "max_wal_size = %dMB" % wal_size)
+    ssd = host.disk_iops("/var/tmp") >= 5000
+    context['random_page_cost'] = 1.1 if ssd else 4.0
+    context['effective_io_concurrency'] = 200 if ssd else 2
+    return context
+
+
+def config_templates():
+    configs = [
+        templates.Template(
+            "../conf/postgresql/pg_hba.conf",
+            conf_dir() + "/pg_hba.conf",
+        ),
+        templates.Template(
+            "../conf/postgresql/tuning.conf",
+            conf_dir() + "/tuning.conf",
+            context=tuning(),
+        ),
+    ]
+    if enabled_pgbouncer():
+        password = "md5" + hashlib.md5(
+            (PASSWORD + USER).encode()).hexdigest()
+        configs += [
+            templates.Template(
+                "../conf/pgbouncer/pgbouncer.ini",
+                "/etc/pgbouncer/pgbouncer.ini",
+                context={
+                    'pool_mode': env.pgbouncer_pool_mode,
+                    'pool_size': pool_size(),
+                    'reserve_pool_size': RESERVE_POOL_SIZE,
+                },
+            ),
+            templates.Template(
+                "../conf/pgbouncer/userlist.txt",
+                "/etc/pgbouncer/userlist.txt",
+                context={'password': password},
+                mode="640",
+            ),
+        ]
+    return configs
+
+
+def configure(commands):
+    postgresql_conf = conf_dir() + "/postgresql.conf"
+    commands.sudo("grep -q \"^include 'tuning.conf'\" %(conf)s || "
+                  "echo \"include 'tuning.conf'\" >> %(conf)s" % {
+                      'conf': postgresql_conf})
+    configs = config_templates()
+    restart = templates.changed("postgresql", [
+        template for template in configs
+        if template.remote.startswith("/etc/postgresql/")])
+    if restart:
+        commands.sudo("service postgresql restart")
+        commands.run(restart)
+    if enabled_pgbouncer():
+        commands.sudo("chown postgres:postgres /etc/pgbouncer/userlist.txt")
+        commands.sudo("sed -i 's/^START=0/START=1/' /etc/default/pgbouncer "
+                      "2>/dev/null || true")
+        restart = templates.changed("pgbouncer", [
+            template for template in configs
+            if template.remote.startswith("/etc/pgbouncer/")])
+        if restart:
+            commands.sudo("service pgbouncer restart")
+            commands.run(restart)
@@ -0,0 +1,147 @@
+from __future__ import print_function
+
+from fabric import state
+from fabric.api import env
+from fabric.network import disconnect_all
+from fabric.colors import green, red, yellow
+from common import timings as deploy_timings
+
+import multiprocessing
+import sys
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+OK = "OK"
+FAILED = "Fail"
+SKIPPED = "Skipped"
+
+# Exit code of the steps skipped because their inputs didn't change
+UNCHANGED = 3
+
+
+class Step(object):
+
+    def __init__(self, task, after=(), locks=(), exclusive=False):
+        self.task = task
+        self.name = task.__name__
+        self.after = [dependency.__name__ for dependency in after]
+        self.locks = set(locks)
+        # Exclusive steps run alone, e.g. to measure the host unloaded
+        self.exclusive = exclusive
+
+
+def check_steps(steps):
+    names = [step.name for step in steps]
+    for step in steps:
+        for dependency in step.after:
+            if dependency not in names:
+                raise ValueError("Step %s depends on unknown step %s" % (
+                    step.name, dependency))
+    done = set()
+    pending = list(steps)
+    while pending:
+        ready = [step for step in pending if set(step.after) <= done]
+        if not ready:
+            raise ValueError("Circular dependency between steps: %s" % (
+                ", ".join(step.name for step in pending)))
+        for step in ready:
+            done.add(step.name)
+            pending.remove(step)
+
+
+def _run_step(step):
+    state.connections.clear()
+    env.step_failed = False
+    env.step_unchanged = False
+    # Steps run side by side, so each one prints its lines at once when it
+    # finishes instead of interleaving them with the other steps
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        step.task()
+    finally:
+        disconnect_all()
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+        stdout.write(output)
+        stdout.flush()
+    if env.step_failed:
+        sys.exit(1)
+    sys.exit(UNCHANGED if env.step_unchanged else 0)
+
+
+def run_steps(steps, pool_size=None):
+    check_steps(steps)
+    start = time.time()
+    pool_size = int(pool_size or env.get('steps_pool_size') or len(steps))
+    pending = list(steps)
+    running = {}
+    results = {}
+    timings = {}
+    started_at = {}
+    unchanged = set()
+    while pending or running:
+        locked = set()
+        exclusive = False
+        for process, step, started in running.values():
+            locked |= step.locks
+            exclusive = exclusive or step.exclusive
+        for step in list(pending):
+            blocked = [name for name in step.after
+                       if results.get(name) in (FAILED, SKIPPED)]
+            if blocked:
+                pending.remove(step)
+                results[step.name] = SKIPPED
+                timings[step.name] = 0.0
+                continue
+            ready = all(results.get(name) == OK for name in step.after)
+            if ready and step.exclusive and running:
+                # Hold the other steps back until it can start
+                exclusive = True
+                continue
+            if (not ready or exclusive or len(running) >= pool_size or
+                    step.locks & locked):
+                continue
+            process = multiprocessing.Process(target=_run_step, args=(step,))
+            process.start()
+            running[step.name] = (process, step, time.time())
+            started_at[step.name] = time.time() - start
+            locked |= step.locks
+            exclusive = step.exclusive
+            pending.remove(step)
+        for name, (process, step, started) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            results[name] = (OK if process.exitcode in (0, UNCHANGED)
+                             else FAILED)
+            if process.exitcode == UNCHANGED:
+                unchanged.add(name)
+            timings[name] = time.time() - started
+            del running[name]
+        time.sleep(0.1)
+    elapsed = time.time() - start
+    print_report(steps, results, timings, elapsed)
+    deploy_timings.record([{
+        'step': step.name,
+        'result': results[step.name],
+        'unchanged': step.name in unchanged,
+        'started': round(started_at.get(step.name, 0.0), 3),
+        'duration': round(timings[step.name], 3),
+    } for step in steps], elapsed, pool_size)
+    return results
+
+
+def print_report(steps, results, timings, elapsed):
+    colors = {OK: green, FAILED: red, SKIPPED: yellow}
+    width = max(len(step.name) for step in steps) + 2
+    print("\nStep timings for %s:" % env.host_string)
+    for step in steps:
+        result = results[step.name]
+        print("%s%8.1fs  [%s]" % (
+            step.name.ljust(width), timings[step.name],
+            colors[result](result)))
+    print("%s%8.1fs" % ("total".ljust(width), elapsed))
@@ -0,0 +1,119 @@
+from fabric.api import run, sudo, put
+from common import batch, fingerprint
+
+import hashlib
+import io
+import json
+import os
+import posixpath
+import tarfile
+import tempfile
+
+
+class Template(object):
+
+    def __init__(self, local, remote, context=None, use_sudo=True, mode=None):
+        self.local = local
+        self.remote = remote
+        self.context = context
+        self.use_sudo = use_sudo
+        self.mode = mode
+
+    def render(self):
+        with open(self.local) as f:
+            text = f.read()
+        if self.context:
+            text = text % self.context
+        return text.encode('utf-8')
+
+
+def remote_digests(templates):
+    paths = " ".join(template.remote for template in templates)
+    command = "sha1sum %s 2>/dev/null || true" % paths
+    if any(template.use_sudo for template in templates):
+        output = sudo(command)
+    else:
+        output = run(command)
+    digests = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            digests[parts[1]] = parts[0]
+    return digests
+
+
+def upload(templates):
+    templates = list(templates)
+    if not templates:
+        return []
+    rendered = [(template, template.render()) for template in templates]
+    digests = remote_digests(templates)
+    changed = [(template, content) for template, content in rendered
+               if digests.get(template.remote) !=
+               hashlib.sha1(content).hexdigest()]
+    if not changed:
+        return []
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for index, (template, content) in enumerate(changed):
+            info = tarfile.TarInfo(str(index))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    # The rendered files may hold passwords, so they are staged in a private
+    # directory and copied out of it as root
+    staging = run("mktemp -d /tmp/devops-templates.XXXXXXXX").strip()
+
+    handle, local_archive = tempfile.mkstemp(suffix=".tar.gz")
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(archive.getvalue())
+        put(local_archive, staging + "/templates.tar.gz")
+    finally:
+        os.remove(local_archive)
+
+    with batch.Batch() as commands:
+        commands.run("tar xzf %(dir)s/templates.tar.gz -C %(dir)s" % {
+            'dir': staging})
+        for index, (template, content) in enumerate(changed):
+            target = template.remote
+            # Named after the staging directory, so two steps uploading the
+            # same file don't write to the same temporary file
+            temporary = posixpath.join(posixpath.dirname(target), ".%s.%s" % (
+                posixpath.basename(target), posixpath.basename(staging)))
+            source = "%s/%d" % (staging, index)
+            if template.mode:
+                copy = "install -m %s %s %s" % (template.mode, source,
+                                                 temporary)
+            else:
+                copy = "cp %s %s" % (source, temporary)
+            command = "mkdir -p %s && %s && mv -f %s %s" % (
+                posixpath.dirname(target), copy, temporary, target)
+            if template.use_sudo:
+                commands.sudo(command)
+            else:
+                commands.run(command)
+        commands.run("rm -rf %s" % staging)
+    return [template.remote for template, content in changed]
+
+
+def changed(name, templates):
+    # A service is restarted only when its files on the host differ from
+    # the ones it was last restarted with, whichever step uploaded them.
+    # Returns the command recording the current files, None if unchanged.
+    templates = list(templates)
+    digests = remote_digests(templates) if templates else {}
+    current = hashlib.sha1(
+        json.dumps(digests, sort_keys=True).encode()).hexdigest()
+    path = fingerprint.state_path(name + ".files")
+    recorded = run("cat %s 2>/dev/null || true" % path).strip()
+    if recorded == current and not fingerprint.forced():
+        return None
+    return "mkdir -p %s && echo %s > %s" % (fingerprint.STATE_DIR, current,
+                                             path)
+
+
+def enable(template):
+    directory = posixpath.dirname(template.remote)
+    return "ln -nsf %s %s/" % (template.remote,
+                               directory.replace("-available", "-enabled"))
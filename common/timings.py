@@ -0,0 +1,101 @@
+from fabric.api import run, env
+from fabric.utils import warn
+from common import fingerprint
+
+import base64
+import datetime
+import json
+import os
+import socket
+import subprocess
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+warned = []
+
+
+def warn_once(message):
+    if not warned:
+        warned.append(message)
+        warn(message)
+
+
+def statsd_address():
+    host, _, port = env.deploy_statsd.partition(":")
+    return host, int(port or 8125)
+
+
+def send_remote(lines):
+    # The statsd of the deployed host is reached through the SSH connection,
+    # env.host may be an ssh_config alias and 8125 is rarely open to us
+    payload = base64.b64encode("\n".join(lines).encode()).decode()
+    result = run("echo %s | base64 -d | nc -u -w1 127.0.0.1 8125" % payload,
+                 quiet=True)
+    if result.failed:
+        warn_once("Couldn't send the deploy timings to the statsd of %s: %s"
+                  % (env.host_string, result))
+
+
+def send_local(lines):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        address = statsd_address()
+        for line in lines:
+            sock.sendto(line.encode(), address)
+    except (socket.error, ValueError) as e:
+        warn_once("Couldn't send the deploy timings to %s: %s"
+                  % (env.deploy_statsd, e))
+    finally:
+        sock.close()
+
+
+def send(steps, elapsed):
+    prefix = "deploy.%s." % env.component
+    lines = ["%s%s.%s:1|c" % (prefix, step['step'], step['result'].lower())
+             for step in steps]
+    # Steps skipped by their fingerprint would drag the timers down
+    lines += ["%s%s.duration:%d|ms" % (prefix, step['step'],
+                                        step['duration'] * 1000)
+              for step in steps
+              if step['result'] != "Skipped" and not step['unchanged']]
+    lines.append("%stotal.duration:%d|ms" % (prefix, elapsed * 1000))
+    if env.get('deploy_statsd'):
+        send_local(lines)
+    else:
+        send_remote(lines)
+
+
+def write_log(run):
+    directory = os.path.expanduser(env.deploy_logs)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "%s-%s-%s.json" % (
+        env.component, env.host.replace(":", "_"),
+        run['date'].replace("-", "").replace(":", "")))
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+    return path
+
+
+def record(steps, elapsed, pool_size):
+    if env.get('deploy_timings'):
+        send(steps, elapsed)
+    if env.get('deploy_logs'):
+        write_log({
+            'component': env.component,
+            'host': env.host_string,
+            'date': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'revision': revision(),
+            'forced': fingerprint.forced(),
+            'pool_size': pool_size,
+            'duration': round(elapsed, 3),
+            'steps': steps,
+        })
@@ -0,0 +1,25 @@
+from common import host
+
+OPTIONS = ("cheaper", "harakiri", "max-requests")
+
+
+def workers(overrides, process_memory_mb, threads, processes_per_core):
+    # Bound the processes by the cores and by a quarter of the RAM, so the
+    # other services on the host keep their share
+    processes = min(host.cores() * processes_per_core,
+                    host.memory_mb() // 4 // process_memory_mb)
+    layout = {'processes': max(2, processes), 'threads': threads}
+    layout.update(overrides)
+    return layout
+
+
+def context(layout, **extra):
+    options = ["%s = %s" % (option, layout[option])
+               for option in OPTIONS if layout.get(option)]
+    context = {
+        'processes': layout['processes'],
+        'threads': layout['threads'],
+        'options': "\n".join(options),
+    }
+    context.update(extra)
+    return context
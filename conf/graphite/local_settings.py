@@ -10,7 +10,13 @@ DATABASES = {
         'NAME': 'graphite',
         'USER': 'dashboard',
         'PASSWORD': 'dashboard',
-        'HOST': 'localhost',
-        'PORT': ''
+        'HOST': '%(db_host)s',
+        'PORT': '%(db_port)s'
     }
 }
+
+CARBONLINK_HOSTS = '%(carbonlink_hosts)s'.split(',')
+
+MEMCACHE_HOSTS = [host for host in '%(memcache_hosts)s'.split(',') if host]
+DEFAULT_CACHE_DURATION = %(default_cache_duration)s
+FIND_CACHE_DURATION = %(find_cache_duration)s
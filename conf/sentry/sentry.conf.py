@@ -13,8 +13,8 @@ DATABASES = {
         'NAME': 'sentry',
         'USER': 'dashboard',
         'PASSWORD': 'dashboard',
-        'HOST': '',
-        'PORT': '',
+        'HOST': '%(db_host)s',
+        'PORT': '%(db_port)s',
     }
 }
 
@@ -44,7 +44,21 @@ SENTRY_REDIS_OPTIONS = {
     'hosts': {
         0: {
             'host': '127.0.0.1',
-            'port': 6379,
+            'port': %(cache_port)s,
+            'db': %(cache_db)s,
+        }
+    }
+}
+
+# The buffers, digests and the queue broker hold data that can't be evicted,
+# they can live on another database or instance than the cache and the TSDB
+
+SENTRY_QUEUE_REDIS_OPTIONS = {
+    'hosts': {
+        0: {
+            'host': '127.0.0.1',
+            'port': %(queue_port)s,
+            'db': %(queue_db)s,
         }
     }
 }
@@ -79,7 +93,7 @@ SENTRY_CACHE = 'sentry.cache.redis.RedisCache'
 # information on configuring your queue broker and workers. Sentry relies
 # on a Python framework called Celery to manage queues.
 
-BROKER_URL = 'redis://localhost:6379'
+BROKER_URL = 'redis://localhost:%(queue_port)s/%(queue_db)s'
 
 ###############
 # Rate Limits #
@@ -100,6 +114,7 @@ SENTRY_RATELIMITER = 'sentry.ratelimits.redis.RedisRateLimiter'
 # (read: if you send any kind of real data to Sentry, you should enable buffers)
 
 SENTRY_BUFFER = 'sentry.buffer.redis.RedisBuffer'
+SENTRY_BUFFER_OPTIONS = SENTRY_QUEUE_REDIS_OPTIONS
 
 ##########
 # Quotas #
@@ -126,6 +141,7 @@ SENTRY_TSDB = 'sentry.tsdb.redis.RedisTSDB'
 # The digest backend powers notification summaries.
 
 SENTRY_DIGESTS = 'sentry.digests.backends.redis.RedisBackend'
+SENTRY_DIGESTS_OPTIONS = SENTRY_QUEUE_REDIS_OPTIONS
 
 ################
 # File storage #
@@ -1,5 +1,5 @@
 {
-  graphitePort: 2003
+  graphitePort: %(graphite_port)s
 , graphiteHost: "localhost"
 , port: 8125
 , graphite: {
@@ -1,11 +1,14 @@
 from __future__ import print_function
 
 from fabric.api import run, sudo, env, cd, prefix, put
-from fabric.contrib import files
 from contextlib import contextmanager as customcontextmanager
 from fabric.state import output
 from fabric.colors import green, red
 
+import glob
+import io
+import json
+import string
 import sys
 import os
 
@@ -13,20 +16,47 @@ sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 sys.path.append('../')
 
 from settings import *
+from common import artifacts, batch, fingerprint, host, scheduler, templates
+from common import benchmark, letsencrypt, nginx, postgres, uwsgi
 
 system_packages = ("git python-pip nginx libcairo2-dev python-cairo libffi-dev "
                    "libssl-dev libboost-python-dev fontconfig bc postgresql "
                    "postgresql-contrib libpq-dev adduser libfontconfig "
                    "nodejs npm devscripts debhelper python-virtualenv uwsgi "
-                   "uwsgi-plugin-python python-psycopg2")
+                   "uwsgi-plugin-python python-psycopg2 fio")
+if USE_MEMCACHED:
+    system_packages += " memcached"
+if USE_PGBOUNCER:
+    system_packages += " pgbouncer"
+if USE_COLLECTD:
+    system_packages += " collectd-core"
 
 env.hosts = HOSTS
 env.user = USER
+env.component = "dashboard"
 env.dir = GRAPHITE_DIR
+env.socket = "127.0.0.1:3031"
+if UWSGI_UNIX_SOCKETS:
+    env.socket = "/run/uwsgi/app/graphite/socket"
 env.activate = "source " + env.dir + "/bin/activate"
 env.use_ssh_config = SSH_CONFIG
+env.artifact_cache = ARTIFACT_CACHE
+env.deploy_timings = SEND_DEPLOY_TIMINGS
+env.deploy_statsd = DEPLOY_STATSD
+env.deploy_logs = DEPLOY_LOGS
+env.benchmark_reports = BENCHMARK_REPORTS
+env.postgres_memory = POSTGRES_MEMORY
+env.pgbouncer = USE_PGBOUNCER
+env.pgbouncer_pool_mode = PGBOUNCER_POOL_MODE
+env.steps_pool_size = STEPS_POOL_SIZE
+env.parallel = PARALLEL_HOSTS
+env.pool_size = HOSTS_POOL_SIZE
 env.ssl_cert_path = SSL_CERTIFICATE_PATH
 env.ssl_key_path = SSL_CERTIFICATE_KEY_PATH
+env.domain = SUBDOMAINS['grafana'] if USE_SUBDOMAINS else DOMAIN
+if USE_LETSENCRYPT:
+    env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % env.domain
+    env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % env.domain
 
 output['everything'] = False
 output['aborts'] = False
@@ -50,6 +80,7 @@ def print_fail(exception):
     print(red("Fail"), end="")
     print("]\n")
     print(exception)
+    env.step_failed = True
 
 
 class AbortException(Exception):
@@ -57,38 +88,100 @@ class AbortException(Exception):
 
 env.abort_exception = AbortException
 
+graphite_files = fingerprint.files("../conf/graphite/*")
+carbon_settings = (CARBON_CACHES, TUNE_CARBON, CARBON_AGGREGATOR,
+                   AGGREGATOR_FORWARD_ALL, AGGREGATION_RULES)
+memcached_settings = (USE_MEMCACHED, MEMCACHED_MEMORY, GRAPHITE_CACHE_DURATION,
+                      GRAPHITE_FIND_CACHE_DURATION)
+grafana_files = fingerprint.files("../conf/grafana/*")
+grafana_settings = (GRAFANA_USER, GRAFANA_PASSWORD, GRAFANA_SESSIONS,
+                    GRAFANA_REDIS)
+statsd_files = fingerprint.files("../conf/statsd/*")
+statsd_settings = (CARBON_CACHES, CARBON_AGGREGATOR)
+databases = ("graphite", "grafana")
+postgres_settings = (POSTGRES_MEMORY, USE_PGBOUNCER, PGBOUNCER_POOL_MODE)
+webserver_files = fingerprint.files("../conf/nginx/*",
+                                    "../conf/uwsgi/graphite.ini")
+webserver_settings = (USE_SUBDOMAINS, USE_SSL, USE_LETSENCRYPT, DOMAIN,
+                      SUBDOMAINS, SSL_CERTIFICATE_PATH,
+                      SSL_CERTIFICATE_KEY_PATH, NGINX_SSL, NGINX_PROXY,
+                      GRAPHITE_UWSGI,
+                      UWSGI_UNIX_SOCKETS,
+                      GRAPHITE_RENDER_CACHE, GRAPHITE_RENDER_CACHE_TTL,
+                      GRAPHITE_RENDER_CACHE_SIZE, GRAPHITE_GZIP,
+                      STATIC_EXPIRES)
 
-def full_installation():
-    install_system_packages()
-    create_virtualenv()
-    install_pip_packages()
-    install_graphite()
-    install_grafana()
-    install_statsd()
-    create_db_user()
-    create_db()
-    config_graphite()
-    config_grafana()
-    config_statsd()
-    config_webserver()
-    sync_db()
-    restart_carbon()
-    restart_statsd()
-    restart_grafana()
-    restart_webserver()
 
+def full_installation(pool_size=None, force=False):
+    if force:
+        env.force = force
+    Step = scheduler.Step
+    scheduler.run_steps([
+        Step(install_system_packages),
+        Step(probe_disk, after=[install_system_packages], exclusive=True),
+        Step(create_virtualenv, after=[install_system_packages]),
+        Step(install_pip_packages, after=[create_virtualenv]),
+        Step(install_graphite, after=[install_pip_packages]),
+        Step(install_grafana, after=[install_system_packages], locks=["dpkg"]),
+        Step(build_statsd, after=[install_system_packages]),
+        Step(install_statsd, after=[build_statsd], locks=["dpkg"]),
+        Step(config_db, after=[probe_disk]),
+        Step(create_db_user, after=[config_db]),
+        Step(create_db, after=[create_db_user]),
+        Step(upload_configs,
+             after=[install_graphite, install_grafana, install_statsd,
+                    probe_disk]),
+        Step(config_graphite, after=[upload_configs]),
+        Step(config_grafana, after=[upload_configs, create_db]),
+        Step(config_statsd, after=[upload_configs]),
+        Step(config_webserver, after=[upload_configs]),
+        Step(config_memcached, after=[upload_configs]),
+        Step(config_collectd, after=[upload_configs, restart_carbon]),
+        Step(sync_db, after=[config_graphite, create_db]),
+        Step(collect_static, after=[config_graphite]),
+        Step(restart_carbon, after=[config_graphite]),
+        Step(restart_statsd, after=[config_statsd]),
+        Step(restart_grafana, after=[config_grafana, create_db]),
+        Step(install_graphite_datasource, after=[restart_grafana]),
+        Step(install_host_dashboard, after=[install_graphite_datasource]),
+        Step(restart_webserver,
+             after=[config_webserver, config_memcached, sync_db,
+                    collect_static]),
+    ], pool_size)
 
+
+@fingerprint.track(system_packages)
 def install_system_packages():
     print("Installing system packages. This could take a few minutes...",
           end="\t")
     try:
-        sudo("apt-get update")
-        sudo("apt-get -y install %s" % system_packages)
+        key = ("apt", system_packages, artifacts.platform())
+        cached = artifacts.push(key, "/var/cache/apt/archives", use_sudo=True)
+        with batch.Batch() as commands:
+            commands.sudo("apt-get update")
+            commands.sudo("apt-get -y install %s" % system_packages)
+        if not cached:
+            artifacts.fetch(key, "/var/cache/apt/archives", "*.deb")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def probe_disk():
+    print("Measuring the disk IOPS...", end="\t")
+    try:
+        # Measured while no other step loads the disk, the result is kept
+        # on the host for the configuration steps
+        run("mkdir -p " + env.dir)
+        paths = (env.dir, "/var/tmp")
+        iops = [(host.disk_iops(path), path) for path in paths]
         print_succeed()
+        print("  " + ", ".join("%d IOPS on %s" % probe for probe in iops))
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
 def create_virtualenv():
     print("Creating virtual environment...", end="\t")
     try:
@@ -98,67 +191,141 @@ def create_virtualenv():
         print_fail(e)
 
 
+@fingerprint.track(env.dir, fingerprint.files("requirements.txt"))
 def install_pip_packages():
     print("Installing pip packages...", end="\t")
     try:
+        key = ("wheels", artifacts.file_digest("requirements.txt"),
+               artifacts.platform())
         with virtualenv():
             put("requirements.txt", "~/")
-            run("pip install -r ~/requirements.txt")
-            run("rm -f ~/requirements.txt")
+            put(io.BytesIO(artifacts.wheel_requirements(
+                "requirements.txt").encode()), "~/requirements-wheels.txt")
+            cached = artifacts.push(key, "~/wheelhouse")
+            with batch.Batch() as commands:
+                if cached:
+                    commands.run("pip install --no-index "
+                                 "--find-links ~/wheelhouse "
+                                 "-r ~/requirements-wheels.txt")
+                elif artifacts.enabled():
+                    commands.run("pip install wheel")
+                    commands.run("pip wheel -r ~/requirements.txt "
+                                 "-w ~/wheelhouse")
+                    commands.run("pip install --no-index "
+                                 "--find-links ~/wheelhouse "
+                                 "-r ~/requirements-wheels.txt")
+                else:
+                    commands.run("pip install -r ~/requirements.txt")
+                commands.run("rm -f ~/requirements.txt "
+                             "~/requirements-wheels.txt")
+            if not cached:
+                artifacts.fetch(key, "~/wheelhouse", "*.whl")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
 def install_graphite():
     print("Installing Graphite. This could take a few minutes...", end="\t")
     try:
+        # Ceres and whisper come with the pip packages. The --install-option
+        # below only applies to source distributions, so those are cached
+        # instead of wheels
+        key = ("graphite", artifacts.platform())
+        packages = ""
         with virtualenv():
-            run("pip install "
-                "https://github.com/graphite-project/ceres/tarball/master")
-            run("pip install whisper")
-            run("pip install carbon --install-option='--prefix=%(dir)s' "
-                "--install-option='--install-lib=%(dir)s/lib'" % {
-                    'dir': env.dir
-                })
-            run("pip install graphite-web --install-option='--prefix=%(dir)s' "
-                "--install-option='--install-lib=%(dir)s/webapp'" % {
-                    'dir': env.dir
-                })
+            cached = artifacts.push(key, "~/graphite-packages")
+            with batch.Batch() as commands:
+                if not cached and artifacts.enabled():
+                    commands.run("pip install --download ~/graphite-packages "
+                                 "--no-use-wheel carbon graphite-web")
+                if cached or artifacts.enabled():
+                    packages = "--no-index --find-links ~/graphite-packages "
+                commands.run("pip install %(packages)scarbon "
+                             "--install-option='--prefix=%(dir)s' "
+                             "--install-option='--install-lib=%(dir)s/lib'" % {
+                                 'packages': packages, 'dir': env.dir
+                             })
+                commands.run("pip install %(packages)sgraphite-web "
+                             "--install-option='--prefix=%(dir)s' "
+                             "--install-option='--install-lib=%(dir)s/webapp'"
+                             % {'packages': packages, 'dir': env.dir})
+            if not cached:
+                artifacts.fetch(key, "~/graphite-packages", "*")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(GRAFANA_DEB)
 def install_grafana():
     print("Installing Grafana...", end="\t")
     try:
-        run("wget "+GET_GRAFANA)
-        sudo("dpkg -i "+GRAFANA_DEB)
-        sudo("rm -f "+GRAFANA_DEB)
+        key = ("grafana", GET_GRAFANA)
+        if artifacts.download(key, GET_GRAFANA):
+            artifacts.push(key, "~")
+        else:
+            run("wget "+GET_GRAFANA)
+        with batch.Batch() as commands:
+            commands.sudo("dpkg -i "+GRAFANA_DEB)
+            commands.sudo("rm -f "+GRAFANA_DEB)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(STATSD_VERSION)
+def build_statsd():
+    print("Building Statsd package...", end="\t")
+    try:
+        key = ("statsd", STATSD_VERSION, artifacts.platform())
+        if not artifacts.push(key, "~/statsd-build"):
+            with batch.Batch() as commands:
+                commands.run("rm -rf statsd-build && mkdir statsd-build")
+                commands.run("git clone --branch %s "
+                             "https://github.com/etsy/statsd.git "
+                             "statsd-build/statsd" % STATSD_VERSION)
+                commands.run("cd statsd-build/statsd && dpkg-buildpackage")
+            artifacts.fetch(key, "~/statsd-build", "statsd_*.deb")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(STATSD_VERSION)
 def install_statsd():
     print("Installing Statsd...", end="\t")
     try:
-        run("git clone https://github.com/etsy/statsd.git")
-        run("cd statsd && dpkg-buildpackage")
-        sudo("dpkg -i statsd*.deb")
+        sudo("dpkg -i statsd-build/statsd_*.deb")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+def config_db():
+    print("Configuring PostgreSQL...", end="\t")
+    try:
+        templates.upload(postgres.config_templates())
+        with batch.Batch() as commands:
+            postgres.configure(commands)
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(postgres.USER, postgres.PASSWORD)
 def create_db_user():
     print("Creating database user...", end="\t")
-    query = "SELECT 1 FROM pg_roles WHERE rolname='dashboard';"
+    query = "SELECT 1 FROM pg_roles WHERE rolname='%s';" % postgres.USER
     try:
-        if not sudo("psql -tAc \""+query+"\"", user="postgres"):
-            sudo("psql -c \"CREATE USER dashboard WITH PASSWORD 'dashboard';\"",
-                 user="postgres")
+        with batch.Batch() as commands:
+            commands.sudo("psql -tAc \""+query+"\" | grep -q 1 || "
+                          "psql -c 'CREATE USER %s;'" % postgres.USER,
+                          user="postgres")
+            # Set again for an existing user, in case the password changed
+            commands.sudo("psql -c \"ALTER USER %s WITH PASSWORD '%s';\"" % (
+                postgres.USER, postgres.PASSWORD), user="postgres")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -166,102 +333,495 @@ def create_db_user():
 
 def db_exists(name):
     query = "SELECT 1 FROM pg_database WHERE datname = '%s';" % name
-    return sudo("psql -tAc \""+query+"\"", user="postgres")
+    return "psql -tAc \""+query+"\" | grep -q 1"
 
 
+@fingerprint.track(databases, postgres.USER)
 def create_db():
     print("Creating databases...", end="\t")
     try:
-        if not db_exists("graphite"):
-            sudo("psql -c 'CREATE DATABASE graphite;'", user="postgres")
-        if not db_exists("grafana"):
-            sudo("psql -c 'CREATE DATABASE grafana;'", user="postgres")
-        sudo("psql -c 'GRANT ALL PRIVILEGES ON DATABASE graphite TO "
-             "dashboard;'", user="postgres")
-        sudo("psql -c 'GRANT ALL PRIVILEGES ON DATABASE grafana TO dashboard;'",
-             user="postgres")
+        with batch.Batch() as commands:
+            for name in databases:
+                commands.sudo(db_exists(name) + " || "
+                              "psql -c 'CREATE DATABASE %s;'" % name,
+                              user="postgres")
+                commands.sudo("psql -c 'GRANT ALL PRIVILEGES ON DATABASE %s "
+                              "TO %s;'" % (name, postgres.USER),
+                              user="postgres")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def carbon_instances():
+    count = min(CARBON_CACHES or host.cores(), len(string.ascii_lowercase))
+    return list(string.ascii_lowercase[:count])
+
+
+def carbon_context():
+    instances = carbon_instances()
+    context = {
+        'cache_line_port': 2003,
+        'cache_pickle_port': 2004,
+        'cache_query_port': 7002,
+        'cache_instances': "",
+        'relay_line_port': 2013,
+        'relay_pickle_port': 2014,
+        'relay_method': "rules",
+        'relay_destinations': "127.0.0.1:2004",
+        'carbonlink_hosts': "127.0.0.1:7002:a",
+    }
+    if len(instances) == 1:
+        return context
+    sections = []
+    for index, name in enumerate(instances):
+        ports = {
+            'name': name,
+            'line': 2103 + 100 * index,
+            'pickle': 2104 + 100 * index,
+            'query': 7102 + 100 * index,
+        }
+        if index:
+            sections.append("[cache:%(name)s]\n"
+                            "LINE_RECEIVER_PORT = %(line)d\n"
+                            "PICKLE_RECEIVER_PORT = %(pickle)d\n"
+                            "CACHE_QUERY_PORT = %(query)d\n" % ports)
+        else:
+            context.update({
+                'cache_line_port': ports['line'],
+                'cache_pickle_port': ports['pickle'],
+                'cache_query_port': ports['query'],
+            })
+    context.update({
+        'cache_instances': "\n".join(sections),
+        'relay_line_port': 2003,
+        'relay_pickle_port': 2004,
+        'relay_method': "consistent-hashing",
+        'relay_destinations': ", ".join(
+            "127.0.0.1:%d:%s" % (2104 + 100 * index, name)
+            for index, name in enumerate(instances)),
+        'carbonlink_hosts': ",".join(
+            "127.0.0.1:%d:%s" % (7102 + 100 * index, name)
+            for index, name in enumerate(instances)),
+    })
+    return context
+
+
+def carbon_line_port():
+    context = carbon_context()
+    if len(carbon_instances()) > 1:
+        return context['relay_line_port']
+    return context['cache_line_port']
+
+
+def carbon_pickle_port():
+    context = carbon_context()
+    if len(carbon_instances()) > 1:
+        return context['relay_pickle_port']
+    return context['cache_pickle_port']
+
+
+def carbon_tuning():
+    instances = len(carbon_instances())
+    if not TUNE_CARBON:
+        return {
+            'max_cache_size': "inf",
+            'max_updates_per_second': 500,
+            'max_creates_per_minute': 50,
+        }
+    iops = host.disk_iops(env.dir)
+    # A cached datapoint takes around 200 bytes, leave 3/4 of the RAM for
+    # the page cache, the webapp and the other services
+    cache_size = host.memory_mb() * 1024 * 1024 // 4 // 200
+    return {
+        'iops': iops,
+        'max_cache_size': cache_size // instances,
+        'max_updates_per_second': max(50, iops * 6 // 10 // instances),
+        'max_creates_per_minute': max(10, iops // 10 // instances),
+    }
+
+
+def carbon_daemons(instance=None):
+    daemons = [(name, "bin/carbon-cache.py --instance=%s" % name)
+               for name in carbon_instances()]
+    if len(daemons) > 1:
+        daemons.append(("relay", "bin/carbon-relay.py --instance=a"))
+    if CARBON_AGGREGATOR:
+        daemons.append(("aggregator",
+                        "bin/carbon-aggregator.py --instance=a"))
+    if instance:
+        daemons = [daemon for daemon in daemons if daemon[0] == instance]
+    return daemons
+
+
+def graphite_templates():
+    context = carbon_context()
+    context.update(carbon_tuning())
+    # The aggregator forwards to whatever receives the metrics without it
+    context.update({
+        'aggregator_forward_all': AGGREGATOR_FORWARD_ALL,
+        'aggregator_destinations': "127.0.0.1:%d" % carbon_pickle_port(),
+    })
+    configs = [
+        templates.Template(path, env.dir + "/conf/" + os.path.basename(path),
+                           use_sudo=False)
+        for path in sorted(glob.glob("../conf/graphite/*.conf"))
+        if os.path.basename(path) not in ("carbon.conf",
+                                          "aggregation-rules.conf")
+    ]
+    return configs + [
+        templates.Template(
+            "../conf/graphite/aggregation-rules.conf",
+            "%s/conf/aggregation-rules.conf" % env.dir,
+            context={'rules': "\n".join(AGGREGATION_RULES)},
+            use_sudo=False,
+        ),
+        templates.Template(
+            "../conf/graphite/carbon.conf",
+            "%s/conf/carbon.conf" % env.dir,
+            context=context,
+            use_sudo=False,
+        ),
+        templates.Template(
+            "../conf/graphite/local_settings.py",
+            "%s/webapp/graphite/local_settings.py" % env.dir,
+            context=dict(
+                postgres.connection(),
+                dir=env.dir,
+                carbonlink_hosts=context['carbonlink_hosts'],
+                memcache_hosts="127.0.0.1:11211" if USE_MEMCACHED else "",
+                default_cache_duration=GRAPHITE_CACHE_DURATION,
+                find_cache_duration=GRAPHITE_FIND_CACHE_DURATION,
+            ),
+            use_sudo=False,
+        ),
+    ]
+
+
+def memcached_templates():
+    if not USE_MEMCACHED:
+        return []
+    # An eighth of the RAM is plenty for render results and find queries
+    memory = MEMCACHED_MEMORY or max(64, host.memory_mb() // 8)
+    return [templates.Template(
+        "../conf/memcached/memcached.conf",
+        "/etc/memcached.conf",
+        context={'memory': memory},
+    )]
+
+
+def collectd_templates():
+    if not USE_COLLECTD:
+        return []
+    return [templates.Template(
+        "../conf/collectd/collectd.conf",
+        "/etc/collectd/collectd.conf",
+        context={
+            'interval': COLLECTD_INTERVAL,
+            'carbon_port': carbon_line_port(),
+        },
+    )]
+
+
+def grafana_root_url():
+    root_url = "http://"
+    if USE_SSL:
+        root_url = "https://"
+    if USE_SUBDOMAINS:
+        root_url += SUBDOMAINS['grafana']
+    else:
+        root_url += DOMAIN + "/grafana"
+    return root_url
+
+
+def grafana_sessions():
+    if GRAFANA_SESSIONS == "postgres":
+        return ("postgres", "user=%(user)s password=%(password)s "
+                "host=%(db_host)s port=%(db_port)s dbname=grafana "
+                "sslmode=disable" % dict(postgres.connection(),
+                                         user=postgres.USER,
+                                         password=postgres.PASSWORD))
+    if GRAFANA_SESSIONS == "redis":
+        return "redis", "addr=%s,pool_size=100,db=3" % GRAFANA_REDIS
+    return "file", "sessions"
+
+
+def grafana_templates():
+    provider, config = grafana_sessions()
+    return [templates.Template(
+        "../conf/grafana/grafana.ini",
+        "/etc/grafana/grafana.ini",
+        context=dict(postgres.connection(), root_url=grafana_root_url(),
+                     admin_user=GRAFANA_USER,
+                     admin_password=GRAFANA_PASSWORD,
+                     session_provider=provider, session_config=config),
+    )]
+
+
+def statsd_templates():
+    port = 2023 if CARBON_AGGREGATOR else carbon_line_port()
+    return [templates.Template(
+        "../conf/statsd/localConfig.js",
+        "/etc/statsd/localConfig.js",
+        context={'graphite_port': port},
+    )]
+
+
+def nginx_site(name, context=None):
+    return templates.Template(
+        "../conf/nginx/" + name,
+        "/etc/nginx/sites-available/" + name,
+        context=context,
+    )
+
+
+def graphite_workers():
+    # Rendering is CPU bound, use single-threaded processes
+    return uwsgi.workers(GRAPHITE_UWSGI, process_memory_mb=60, threads=1,
+                         processes_per_core=2)
+
+
+def postgres_clients():
+    # A connection per graphite-web thread, and a few for Grafana
+    workers = graphite_workers()
+    return workers['processes'] * workers['threads'] + 10
+
+env.postgres_clients = postgres_clients
+
+
+def webserver_templates():
+    if USE_SUBDOMAINS:
+        context = {'server_name': SUBDOMAINS['grafana']}
+        site = "ssl-subdomain-grafana" if USE_SSL else "subdomain-grafana"
+        sites = [nginx_site(site, context)]
+    else:
+        context = {'server_name': DOMAIN}
+        site = "ssl-server" if USE_SSL else "server"
+        sites = [nginx_site("location-grafana"), nginx_site(site, context)]
+    if USE_SSL:
+        context['certificate_path'] = env.ssl_cert_path
+        context['key_path'] = env.ssl_key_path
+        context['ssl_listen'] = nginx.ssl_listen(NGINX_SSL)
+        sites.append(nginx.ssl_params(NGINX_SSL))
+    render_cache = "off"
+    render_cache_path = ""
+    if GRAPHITE_RENDER_CACHE:
+        # nginx only creates the last directory of the path, /var/lib/nginx
+        # is there on every Debian and Ubuntu package
+        render_cache = "graphite_render"
+        render_cache_path = (
+            "uwsgi_cache_path /var/lib/nginx/graphite levels=1:2 "
+            "keys_zone=graphite_render:10m max_size=%s inactive=10m;" %
+            GRAPHITE_RENDER_CACHE_SIZE)
+    return sites + [
+        nginx_site("upstream-grafana",
+                   {'keepalive': NGINX_PROXY['keepalive']}),
+        nginx.proxy_params(NGINX_PROXY),
+        nginx.static_params(STATIC_EXPIRES),
+        nginx_site("graphite", {
+            'static_root': env.dir + "/static",
+            'uwsgi_pass': ("unix:" if UWSGI_UNIX_SOCKETS else "") + env.socket,
+            'render_cache': render_cache,
+            'render_cache_path': render_cache_path,
+            'render_cache_ttl': GRAPHITE_RENDER_CACHE_TTL,
+            'gzip': "on" if GRAPHITE_GZIP else "off",
+        }),
+        templates.Template(
+            "../conf/uwsgi/graphite.ini",
+            "/etc/uwsgi/apps-available/graphite.ini",
+            context=uwsgi.context(
+                graphite_workers(),
+                dir=env.dir,
+                socket=env.socket,
+            ),
+        ),
+    ]
+
+
+def upload_configs():
+    print("Uploading configuration files...", end="\t")
+    try:
+        templates.upload(graphite_templates() + memcached_templates() +
+                         collectd_templates() + postgres.config_templates() +
+                         grafana_templates() + statsd_templates() +
+                         webserver_templates())
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir, graphite_files, carbon_settings,
+                   memcached_settings, postgres_settings)
 def config_graphite():
     print("Configuring Graphite...", end="\t")
     try:
-        run("echo GRAPHITE_ROOT=%s >> .profile" % env.dir)
-        with cd(env.dir):
-            run("cp -f conf/carbon.conf.example conf/carbon.conf")
-            run("cp -f conf/graphite.wsgi.example conf/graphite.wsgi")
-        put("../conf/graphite/*.conf", "%s/conf/" % env.dir)
-        files.upload_template(
-            "../conf/graphite/local_settings.py",
-            "%s/webapp/graphite/" % env.dir,
-            context={'dir': env.dir},
-        )
+        with batch.Batch() as commands:
+            commands.run("grep -q GRAPHITE_ROOT .profile || "
+                         "echo GRAPHITE_ROOT=%s >> .profile" % env.dir)
+            commands.run("cp -f %(dir)s/conf/graphite.wsgi.example "
+                         "%(dir)s/conf/graphite.wsgi" % {'dir': env.dir})
+        templates.upload(graphite_templates())
         sudo("chown -R www-data:www-data graphite/storage/")
         print_succeed()
+        tuning = carbon_tuning()
+        print("  %d carbon-cache instances, %d cores, %d MB RAM, %s IOPS: "
+              "MAX_CACHE_SIZE = %s, MAX_UPDATES_PER_SECOND = %s, "
+              "MAX_CREATES_PER_MINUTE = %s" % (
+                  len(carbon_instances()), host.cores(), host.memory_mb(),
+                  tuning.get('iops', "-"), tuning['max_cache_size'],
+                  tuning['max_updates_per_second'],
+                  tuning['max_creates_per_minute']))
+    except AbortException as e:
+        print_fail(e)
+
+
+def config_memcached():
+    if not USE_MEMCACHED:
+        return
+    print("Configuring memcached...", end="\t")
+    try:
+        memcached = memcached_templates()
+        templates.upload(memcached)
+        restart = templates.changed("memcached", memcached)
+        if restart:
+            with batch.Batch() as commands:
+                commands.sudo("service memcached restart")
+                commands.run(restart)
+        print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(grafana_files, grafana_settings, webserver_settings,
+                   postgres_settings)
 def config_grafana():
     print("Configuring Grafana...", end="\t")
-    root_url = "http://"
-    if USE_SSL:
-        root_url = "https://"
-    if USE_SUBDOMAINS:
-        root_url += SUBDOMAINS['grafana']
-    else:
-        root_url += DOMAIN + "/grafana"
     try:
-        files.upload_template(
-            "../conf/grafana/grafana.ini",
-            "/etc/grafana/",
-            context={'root_url': root_url},
-            use_sudo=True,
-        )
+        templates.upload(grafana_templates())
+        if GRAFANA_SESSIONS == "postgres":
+            # Grafana doesn't create the table of the postgres sessions
+            sudo("psql -d grafana -c 'CREATE TABLE IF NOT EXISTS session ("
+                 "key CHAR(16) NOT NULL PRIMARY KEY, data BYTEA, "
+                 "expiry INTEGER NOT NULL); "
+                 "ALTER TABLE session OWNER TO dashboard;'", user="postgres")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(statsd_files, statsd_settings)
 def config_statsd():
     print("Configuring Statsd...", end="\t")
     try:
-        put("../conf/statsd/localConfig.js", "/etc/statsd/", use_sudo=True)
+        templates.upload(statsd_templates())
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir, fingerprint.files("requirements.txt"))
 def sync_db():
     print("Synchronizing Graphite database...", end="\t")
     try:
         with virtualenv():
-            run("python webapp/graphite/manage.py migrate auth")
-            output['stdout'] = True
-            run("python webapp/graphite/manage.py syncdb")
-            output['stdout'] = False
+            run("python webapp/graphite/manage.py migrate auth --noinput")
+            run("python webapp/graphite/manage.py syncdb --noinput")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def create_superuser():
+    with virtualenv():
+        run("python webapp/graphite/manage.py createsuperuser")
+
+
+@fingerprint.track(env.dir, fingerprint.files("requirements.txt"))
+def collect_static():
+    print("Collecting Graphite static files...", end="\t")
+    try:
+        with virtualenv(), batch.Batch() as commands:
+            commands.run("python webapp/graphite/manage.py collectstatic "
+                         "--noinput")
+            commands.run(nginx.precompress(env.dir + "/static"))
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
 def restart_carbon():
-    print("Restarting carbon daemon...", end="\t")
+    print("Restarting carbon daemons...", end="\t")
     try:
-        with virtualenv():
-            sudo("bin/carbon-cache.py stop")
-            sudo("bin/carbon-cache.py start")
+        daemons = carbon_daemons()
+        restart = templates.changed("carbon", graphite_templates())
+        if restart:
+            with virtualenv(), batch.Batch() as commands:
+                for name, daemon in reversed(daemons):
+                    commands.sudo(daemon + " stop")
+                for name, daemon in daemons:
+                    commands.sudo(daemon + " start")
+                commands.run(restart)
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def start_carbon(instance=None):
+    print("Starting carbon daemons...", end="\t")
+    try:
+        with virtualenv(), batch.Batch() as commands:
+            for name, daemon in carbon_daemons(instance):
+                commands.sudo(daemon + " start")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+def stop_carbon(instance=None):
+    print("Stopping carbon daemons...", end="\t")
+    try:
+        with virtualenv(), batch.Batch() as commands:
+            for name, daemon in reversed(carbon_daemons(instance)):
+                commands.sudo(daemon + " stop")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def carbon_status(instance=None):
+    daemons = carbon_daemons(instance)
+    with virtualenv(), batch.Batch() as commands:
+        for name, daemon in daemons:
+            commands.sudo(daemon + " status || true")
+    for (name, daemon), status in zip(daemons, commands.results):
+        print("%s: %s" % (name, status.strip()))
+
+
 def restart_statsd():
     print("Restarting Statsd service...", end="\t")
     try:
-        sudo("service statsd restart")
+        restart = templates.changed("statsd", statsd_templates())
+        if restart:
+            with batch.Batch() as commands:
+                commands.sudo("service statsd restart")
+                commands.run(restart)
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def config_collectd():
+    if not USE_COLLECTD:
+        return
+    print("Configuring collectd...", end="\t")
+    try:
+        collectd = collectd_templates()
+        templates.upload(collectd)
+        restart = templates.changed("collectd", collectd)
+        if restart:
+            with batch.Batch() as commands:
+                commands.sudo("service collectd restart")
+                commands.run(restart)
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -270,78 +830,91 @@ def restart_statsd():
 def restart_grafana():
     print("Restarting Grafana...", end="\t")
     try:
-        sudo("service grafana-server restart")
+        restart = templates.changed("grafana", grafana_templates())
+        if restart:
+            with batch.Batch() as commands:
+                commands.sudo("service grafana-server restart")
+                commands.run(restart)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+def grafana_api(method, path, data=None):
+    # Grafana takes a few seconds to listen after a restart
+    command = ("for i in $(seq 30); do curl -s -o /dev/null "
+               "http://127.0.0.1:3000/login && break; sleep 2; done; "
+               "curl -sf -X %s -u '%s:%s' -H 'Content-Type: application/json' "
+               "http://127.0.0.1:3000/api/%s" % (
+                   method, GRAFANA_USER, GRAFANA_PASSWORD, path))
+    if data:
+        command += " --data-binary @" + data
+    return command
+
+
+@fingerprint.track(grafana_settings)
+def install_graphite_datasource():
+    print("Adding the Graphite data source to Grafana...", end="\t")
+    try:
+        # Grafana queries graphite-web itself, so the browsers don't open
+        # their own connections to the render API
+        datasource = {
+            'name': "graphite",
+            'type': "graphite",
+            'url': "http://127.0.0.1:8080",
+            'access': "proxy",
+            'basicAuth': False,
+            'isDefault': True,
+        }
+        existing = [source['id'] for source in
+                    json.loads(run(grafana_api("GET", "datasources")))
+                    if source['name'] == datasource['name']]
+        put(io.BytesIO(json.dumps(datasource).encode()),
+            "/tmp/devops-datasource.json")
+        if existing:
+            run(grafana_api("PUT", "datasources/%d" % existing[0],
+                            "/tmp/devops-datasource.json"))
+        else:
+            run(grafana_api("POST", "datasources",
+                            "/tmp/devops-datasource.json"))
+        run("rm -f /tmp/devops-datasource.json")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(fingerprint.files("../conf/grafana/host-dashboard.json"),
+                   USE_COLLECTD, COLLECTD_DASHBOARD)
+def install_host_dashboard():
+    if not (USE_COLLECTD and COLLECTD_DASHBOARD):
+        return
+    print("Installing the host dashboard on Grafana...", end="\t")
+    try:
+        put("../conf/grafana/host-dashboard.json",
+            "/tmp/devops-host-dashboard.json")
+        run(grafana_api("POST", "dashboards/db",
+                        "/tmp/devops-host-dashboard.json"))
+        run("rm -f /tmp/devops-host-dashboard.json")
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(env.dir, webserver_files, webserver_settings)
 def config_webserver():
     if USE_SSL and USE_LETSENCRYPT:
         generate_ssl_certificate()
     print("Configuring webserver...", end="\t")
     try:
-        if USE_SUBDOMAINS:
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-subdomain-grafana",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': SUBDOMAINS['grafana'],
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-subdomain-grafana "
-                     "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/subdomain-grafana",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': SUBDOMAINS['grafana']},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/subdomain-grafana "
-                     "/etc/nginx/sites-enabled/")
-        else:
-            put("../conf/nginx/location-grafana", "/etc/nginx/sites-available/",
-                use_sudo=True)
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-server",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': DOMAIN,
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-server "
-                      "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/server",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': DOMAIN},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/server "
-                      "/etc/nginx/sites-enabled/")
-        put("../conf/nginx/graphite", "/etc/nginx/sites-available/",
-                use_sudo=True)
-        sudo("ln -nsf /etc/nginx/sites-available/graphite "
-              "/etc/nginx/sites-enabled/")
-        sudo("rm -f /etc/nginx/sites-enabled/default")
-        files.upload_template(
-            "../conf/uwsgi/graphite.ini",
-            "/etc/uwsgi/apps-available/",
-            context={'dir': env.dir},
-            use_sudo=True,
-        )
-        sudo("ln -nsf /etc/uwsgi/apps-available/graphite.ini "
-             "/etc/uwsgi/apps-enabled/")
+        webserver = webserver_templates()
+        templates.upload(webserver)
+        with batch.Batch() as commands:
+            for template in webserver:
+                name = os.path.basename(template.remote)
+                if ("-available/" in template.remote and
+                        not name.startswith("location-")):
+                    commands.sudo(templates.enable(template))
+            commands.sudo("rm -f /etc/nginx/sites-enabled/default")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -349,52 +922,10 @@ def config_webserver():
 
 def generate_ssl_certificate():
     print("Generating ssl certificate...", end="\t")
-    if USE_SUBDOMAINS:
-        domain = SUBDOMAINS['grafana']
-        file_prefix = "grafana"
-    else:
-        domain = DOMAIN
-        file_prefix = "cert"
     try:
-        key_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        if not files.exists(key_path, use_sudo=True):
-            if not files.exists("/opt/letsencrypt/"):
-                sudo("git clone https://github.com/letsencrypt/letsencrypt "
-                     "/opt/letsencrypt")
-            sudo("service nginx stop")
-            output['stdout'] = True
-            run("/opt/letsencrypt/letsencrypt-auto certonly --standalone "
-                "--email %(email)s -d %(domain)s" % {
-                    'email': EMAIL, 'domain': domain
-                })
-            output['stdout'] = False
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.ini",
-            "/opt/letsencrypt/"+file_prefix+"-renew.ini",
-            context={'email': EMAIL, 'domain': domain},
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.sh",
-            "/opt/letsencrypt/"+file_prefix+"-renew.sh",
-            context={
-                'domain': domain,
-                'renew_conf': file_prefix+"-renew.ini",
-                'instance_id': INSTANCE_ID,
-                'open_sg': OPEN_SG,
-                'restricted_sg': RESTRICTED_SG,
-            },
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/crontab",
-            "/opt/letsencrypt/"+file_prefix+"-crontab",
-            context={'renew_script': file_prefix+"-renew.sh"},
-            use_sudo=True,
-        )
-        run("crontab /opt/letsencrypt/"+file_prefix+"-crontab")
-        env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % domain
+        if not letsencrypt.exists(env.domain):
+            letsencrypt.issue(env.domain, EMAIL)
+        letsencrypt.install_renewal()
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -403,8 +934,99 @@ def generate_ssl_certificate():
 def restart_webserver():
     print("Restarting webserver...", end="\t")
     try:
-        sudo("service uwsgi restart")
-        sudo("service nginx restart")
+        webserver = webserver_templates()
+        restart_uwsgi = templates.changed("uwsgi", [
+            template for template in graphite_templates() + webserver
+            if template.remote.startswith("/etc/uwsgi/") or
+            template.remote.endswith("/local_settings.py")])
+        restart_nginx = templates.changed("nginx", [
+            template for template in webserver
+            if not template.remote.startswith("/etc/uwsgi/")])
+        with batch.Batch() as commands:
+            if restart_uwsgi:
+                commands.sudo("service uwsgi restart")
+                commands.run(restart_uwsgi)
+            if restart_nginx:
+                commands.sudo("service nginx restart")
+                commands.run(restart_nginx)
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def benchmark_ingest(rate=1000, keys=100, duration=60, timeout=180):
+    parameters = {
+        'rate': int(rate),
+        'keys': int(keys),
+        'duration': int(duration),
+        'carbon_caches': len(carbon_instances()),
+        'cores': host.cores(),
+        'memory_mb': host.memory_mb(),
+    }
+    print("Benchmarking metrics ingestion...", end="\t")
+    try:
+        results = benchmark.run_script("statsd_load.py", [
+            "--rate %d" % parameters['rate'],
+            "--keys %d" % parameters['keys'],
+            "--duration %d" % parameters['duration'],
+            "--timeout %d" % int(timeout),
+            "--whisper-dir %s/storage/whisper" % env.dir,
+        ], python=env.dir+"/bin/python", use_sudo=True)
+        path = benchmark.write_report("ingest", parameters, results)
+        print_succeed()
+        print("Sent %(sent)d metrics at %(achieved_rate).1f/s" %
+              results['load'])
+        ingest = results['ingest']
+        print("Dropped %.2f%% of the counters, flushed in %.1fs, "
+              "%.1f points/s" % (ingest['drop_rate'] * 100,
+                                 ingest['flush_latency'],
+                                 ingest['points_per_second']))
+        print("Carbon dropped %d metric creations" %
+              ingest['dropped_creates'])
+        print("Report written to " + path)
+    except AbortException as e:
+        print_fail(e)
+
+
+def benchmark_render(series=20, concurrency=8, dashboards=2, panels=12,
+                     duration=60, cache=True, cleanup=False):
+    cache = str(cache).lower() in ('1', 'true', 'yes')
+    cleanup = str(cleanup).lower() in ('1', 'true', 'yes')
+    parameters = {
+        'series': int(series),
+        'concurrency': int(concurrency),
+        'dashboards': int(dashboards),
+        'panels': int(panels),
+        'duration': int(duration),
+        'cache': cache,
+        'uwsgi': graphite_workers(),
+        'render_cache': GRAPHITE_RENDER_CACHE and GRAPHITE_RENDER_CACHE_TTL,
+        'memcached': USE_MEMCACHED and GRAPHITE_CACHE_DURATION,
+        'cores': host.cores(),
+        'memory_mb': host.memory_mb(),
+    }
+    arguments = [
+        "--series %d" % parameters['series'],
+        "--concurrency %d" % parameters['concurrency'],
+        "--dashboards %d" % parameters['dashboards'],
+        "--panels %d" % parameters['panels'],
+        "--duration %d" % parameters['duration'],
+        "--whisper-dir %s/storage/whisper" % env.dir,
+        "--conf-dir %s/conf" % env.dir,
+    ]
+    if not cache:
+        arguments.append("--no-cache")
+    if cleanup:
+        arguments.append("--cleanup")
+    print("Benchmarking the render API...", end="\t")
+    try:
+        results = benchmark.run_script("render_load.py", arguments,
+                                       python=env.dir+"/bin/python",
+                                       use_sudo=True)
+        path = benchmark.write_report("render", parameters, results)
         print_succeed()
+        print("%(requests)d requests, %(throughput).1f/s, p50 %(p50_ms)sms, "
+              "p95 %(p95_ms)sms, p99 %(p99_ms)sms" % results['total'])
+        print("Report written to " + path)
     except AbortException as e:
         print_fail(e)
@@ -1,7 +1,6 @@
 from __future__ import print_function
 
-from fabric.api import run, sudo, env, cd, prefix, put
-from fabric.contrib import files
+from fabric.api import run, env
 from fabric.state import output
 from fabric.colors import green, red
 
@@ -12,15 +11,29 @@ sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 sys.path.append('../')
 
 from settings import *
+from common import artifacts, batch, fingerprint, letsencrypt, scheduler
+from common import nginx, templates
 
 system_packages = ("openjdk-7-jre openjdk-7-jdk")
 
 env.hosts = HOSTS
 env.user = USER
+env.component = "jenkins"
 env.dir = JENKINS_DIR
 env.use_ssh_config = SSH_CONFIG
+env.artifact_cache = ARTIFACT_CACHE
+env.deploy_timings = SEND_DEPLOY_TIMINGS
+env.deploy_statsd = DEPLOY_STATSD
+env.deploy_logs = DEPLOY_LOGS
+env.steps_pool_size = STEPS_POOL_SIZE
+env.parallel = PARALLEL_HOSTS
+env.pool_size = HOSTS_POOL_SIZE
 env.ssl_cert_path = SSL_CERTIFICATE_PATH
 env.ssl_key_path = SSL_CERTIFICATE_KEY_PATH
+env.domain = SUBDOMAINS['jenkins'] if USE_SUBDOMAINS else DOMAIN
+if USE_LETSENCRYPT:
+    env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % env.domain
+    env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % env.domain
 
 output['everything'] = False
 output['aborts'] = False
@@ -36,6 +49,7 @@ def print_fail(exception):
     print(red("Fail"), end="")
     print("]\n")
     print(exception)
+    env.step_failed = True
 
 
 class AbortException(Exception):
@@ -43,111 +57,120 @@ class AbortException(Exception):
 
 env.abort_exception = AbortException
 
+webserver_files = fingerprint.files("../conf/nginx/*")
+webserver_settings = (USE_SUBDOMAINS, USE_SSL, USE_LETSENCRYPT, DOMAIN,
+                      SUBDOMAINS, SSL_CERTIFICATE_PATH,
+                      SSL_CERTIFICATE_KEY_PATH, NGINX_SSL,
+                      NGINX_PROXY)
 
-def full_installation():
-    install_system_packages()
-    install_jenkins()
-    config_webserver()
-    restart_webserver()
 
+def full_installation(pool_size=None, force=False):
+    if force:
+        env.force = force
+    Step = scheduler.Step
+    scheduler.run_steps([
+        Step(install_system_packages),
+        Step(install_jenkins, after=[install_system_packages]),
+        Step(config_webserver, after=[install_system_packages]),
+        Step(restart_webserver, after=[install_jenkins, config_webserver]),
+    ], pool_size)
 
+
+@fingerprint.track(system_packages)
 def install_system_packages():
     print("Installing system packages. This could take a few minutes...",
           end="\t")
     try:
-        sudo("apt-get update")
-        sudo("apt-get -y install %s" % system_packages)
+        key = ("apt", system_packages, artifacts.platform())
+        cached = artifacts.push(key, "/var/cache/apt/archives", use_sudo=True)
+        with batch.Batch() as commands:
+            commands.sudo("apt-get update")
+            commands.sudo("apt-get -y install %s" % system_packages)
+        if not cached:
+            artifacts.fetch(key, "/var/cache/apt/archives", "*.deb")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
 def install_jenkins():
     print("Installing Jenkins...", end='\t')
     configure_jenkins()
     try:
-        sudo("wget -q -O - https://jenkins-ci.org/debian/jenkins-ci.org.key | "
-             "sudo apt-key add -")
-        sudo("sudo sh -c 'echo deb http://pkg.jenkins-ci.org/debian binary/ > "
-             "/etc/apt/sources.list.d/jenkins.list'")
-        sudo("apt-get update")
-        sudo("apt-get install jenkins")
+        with batch.Batch() as commands:
+            commands.sudo("wget -q -O - "
+                          "https://jenkins-ci.org/debian/jenkins-ci.org.key | "
+                          "apt-key add -")
+            commands.sudo("echo deb http://pkg.jenkins-ci.org/debian binary/ > "
+                          "/etc/apt/sources.list.d/jenkins.list")
+            commands.sudo("apt-get update")
+            commands.sudo("apt-get -y install jenkins")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
+def jenkins_templates():
+    return [templates.Template(
+        "../conf/jenkins/jenkins",
+        "/etc/default/jenkins",
+        context={'jenkins_dir': env.dir},
+    )]
+
+
 def configure_jenkins():
     print("Configuring Jenkins...", end="\t")
     try:
-        files.upload_template(
-            "../conf/jenkins/jenkins",
-            "/etc/default/",
-            context={'jenkins_dir': env.dir},
-            use_sudo=True,
-        )
+        templates.upload(jenkins_templates())
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+def nginx_site(name, context=None):
+    return templates.Template(
+        "../conf/nginx/" + name,
+        "/etc/nginx/sites-available/" + name,
+        context=context,
+    )
+
+
+def webserver_templates():
+    if USE_SUBDOMAINS:
+        context = {'server_name': SUBDOMAINS['jenkins']}
+        site = "ssl-subdomain-jenkins" if USE_SSL else "subdomain-jenkins"
+        sites = [nginx_site(site, context)]
+    else:
+        context = {'server_name': DOMAIN}
+        site = "ssl-server" if USE_SSL else "server"
+        sites = [nginx_site("location-jenkins"), nginx_site(site, context)]
+    if USE_SSL:
+        context['certificate_path'] = env.ssl_cert_path
+        context['key_path'] = env.ssl_key_path
+        context['ssl_listen'] = nginx.ssl_listen(NGINX_SSL)
+        sites.append(nginx.ssl_params(NGINX_SSL))
+    return sites + [
+        nginx_site("upstream-jenkins",
+                   {'keepalive': NGINX_PROXY['keepalive']}),
+        nginx.proxy_params(NGINX_PROXY),
+    ]
+
+
+@fingerprint.track(webserver_files, webserver_settings)
 def config_webserver():
     if USE_SSL and USE_LETSENCRYPT:
         generate_ssl_certificate()
     print("Configuring webserver...", end="\t")
     try:
-        if USE_SUBDOMAINS:
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-subdomain-jenkins",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': SUBDOMAINS['jenkins'],
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-subdomain-jenkins "
-                     "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/subdomain-jenkins",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': SUBDOMAINS['jenkins']},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/subdomain-jenkins "
-                     "/etc/nginx/sites-enabled/")
-        else:
-            put("../conf/nginx/location-jenkins", "/etc/nginx/sites-available/",
-                use_sudo=True)
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-server",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': DOMAIN,
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-server "
-                      "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/server",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': DOMAIN},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/server "
-                      "/etc/nginx/sites-enabled/")
-        put("../conf/nginx/graphite", "/etc/nginx/sites-available/",
-                use_sudo=True)
-        sudo("ln -nsf /etc/nginx/sites-available/graphite "
-              "/etc/nginx/sites-enabled/")
-        sudo("rm -f /etc/nginx/sites-enabled/default")
+        webserver = webserver_templates()
+        templates.upload(webserver)
+        with batch.Batch() as commands:
+            for template in webserver:
+                name = os.path.basename(template.remote)
+                if ("-available/" in template.remote and
+                        not name.startswith("location-")):
+                    commands.sudo(templates.enable(template))
+            commands.sudo("rm -f /etc/nginx/sites-enabled/default")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -155,56 +178,17 @@ def config_webserver():
 
 def generate_ssl_certificate():
     print("Generating ssl certificate...", end="\t")
-    if USE_SUBDOMAINS:
-        domain = SUBDOMAINS['jenkins']
-        file_prefix = "jenkins"
-    else:
-        domain = DOMAIN
-        file_prefix = "cert"
     try:
-        key_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        if not files.exists(key_path, use_sudo=True):
-            if not files.exists("/opt/letsencrypt/"):
-                sudo("git clone https://github.com/letsencrypt/letsencrypt "
-                     "/opt/letsencrypt")
-            sudo("service nginx stop")
+        if not letsencrypt.exists(env.domain):
+            # The challenges need port 80 open to the world
             if OPEN_SG:
                 change_security_groups(OPEN_SG)
-            output['stdout'] = True
-            run("/opt/letsencrypt/letsencrypt-auto certonly --standalone "
-                "--email %(email)s -d %(domain)s" % {
-                    'email': EMAIL, 'domain': domain
-                })
-            output['stdout'] = False
-            if RESTRICTED_SG:
-                change_security_groups(RESTRICTED_SG)
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.ini",
-            "/opt/letsencrypt/"+file_prefix+"-renew.ini",
-            context={'email': EMAIL, 'domain': domain},
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.sh",
-            "/opt/letsencrypt/"+file_prefix+"-renew.sh",
-            context={
-                'domain': domain,
-                'renew_conf': file_prefix+"-renew.ini",
-                'instance_id': INSTANCE_ID,
-                'open_sg': OPEN_SG,
-                'restricted_sg': RESTRICTED_SG,
-            },
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/crontab",
-            "/opt/letsencrypt/"+file_prefix+"-crontab",
-            context={'renew_script': file_prefix+"-renew.sh"},
-            use_sudo=True,
-        )
-        run("crontab /opt/letsencrypt/"+file_prefix+"-crontab")
-        env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % domain
+            try:
+                letsencrypt.issue(env.domain, EMAIL)
+            finally:
+                if RESTRICTED_SG:
+                    change_security_groups(RESTRICTED_SG)
+        letsencrypt.install_renewal()
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -218,8 +202,15 @@ def change_security_groups(security_groups):
 def restart_webserver():
     print("Restarting webserver...", end="\t")
     try:
-        sudo("service jenkins restart")
-        sudo("service nginx restart")
+        restart_jenkins = templates.changed("jenkins", jenkins_templates())
+        restart_nginx = templates.changed("nginx", webserver_templates())
+        with batch.Batch() as commands:
+            if restart_jenkins:
+                commands.sudo("service jenkins restart")
+                commands.run(restart_jenkins)
+            if restart_nginx:
+                commands.sudo("service nginx restart")
+                commands.run(restart_nginx)
         print_succeed()
     except AbortException as e:
         print_fail(e)
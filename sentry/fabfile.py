@@ -1,7 +1,6 @@
 from __future__ import print_function
 
-from fabric.api import run, sudo, env, cd, prefix, put
-from fabric.contrib import files
+from fabric.api import run, env, cd, prefix
 from contextlib import contextmanager as customcontextmanager
 from fabric.state import output
 from fabric.colors import green, red
@@ -13,19 +12,49 @@ sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 sys.path.append('../')
 
 from settings import *
+from common import artifacts, batch, fingerprint, host, scheduler, templates
+from common import benchmark, letsencrypt, nginx, postgres, uwsgi
 
 system_packages = ("python-virtualenv python-pip python-setuptools python-dev "
                    "libxslt1-dev libxml2-dev libz-dev libffi-dev libssl-dev "
                    "libpq-dev libyaml-dev bc postgresql-contrib supervisor "
-                   "redis-server nginx uwsgi uwsgi-plugin-python git")
+                   "redis-server nginx uwsgi uwsgi-plugin-python git fio")
+if USE_PGBOUNCER:
+    system_packages += " pgbouncer"
 
 env.hosts = HOSTS
 env.user = USER
+env.component = "sentry"
 env.dir = SENTRY_DIR
+env.socket = "http-socket = 127.0.0.1:9000"
+env.sentry_server = "127.0.0.1:9000"
+env.sentry_pass = ("proxy_pass http://sentry; "
+                   "include /etc/nginx/proxy-params.conf;")
+if UWSGI_UNIX_SOCKETS:
+    env.socket = "socket = /run/uwsgi/app/sentry/socket"
+    env.sentry_server = "unix:/run/uwsgi/app/sentry/socket"
+    env.sentry_pass = "include uwsgi_params; uwsgi_pass sentry;"
 env.activate = "source "+env.dir+"/bin/activate"
+env.sentry_static = (env.dir +
+                     "/lib/python2.7/site-packages/sentry/static/sentry")
 env.use_ssh_config = SSH_CONFIG
+env.artifact_cache = ARTIFACT_CACHE
+env.deploy_timings = SEND_DEPLOY_TIMINGS
+env.deploy_statsd = DEPLOY_STATSD
+env.deploy_logs = DEPLOY_LOGS
+env.benchmark_reports = BENCHMARK_REPORTS
+env.postgres_memory = POSTGRES_MEMORY
+env.pgbouncer = USE_PGBOUNCER
+env.pgbouncer_pool_mode = PGBOUNCER_POOL_MODE
+env.steps_pool_size = STEPS_POOL_SIZE
+env.parallel = PARALLEL_HOSTS
+env.pool_size = HOSTS_POOL_SIZE
 env.ssl_cert_path = SSL_CERTIFICATE_PATH
 env.ssl_key_path = SSL_CERTIFICATE_KEY_PATH
+env.domain = SUBDOMAINS['sentry'] if USE_SUBDOMAINS else DOMAIN
+if USE_LETSENCRYPT:
+    env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % env.domain
+    env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % env.domain
 
 output['everything'] = False
 output['aborts'] = False
@@ -49,6 +78,7 @@ def print_fail(exception):
     print(red("Fail"), end="")
     print("]\n")
     print(exception)
+    env.step_failed = True
 
 
 class AbortException(Exception):
@@ -56,34 +86,74 @@ class AbortException(Exception):
 
 env.abort_exception = AbortException
 
-
-def full_installation():
-    install_system_packages()
-    create_virtualenv()
-    install_sentry()
-    config_sentry()
-    create_db_user()
-    create_db()
-    config_db()
-    sync_db()
-    config_supervisor()
-    config_webserver()
-    restart_redis()
-    restart_webserver()
-
-
+sentry_files = fingerprint.files("../conf/sentry/*")
+redis_settings = (REDIS_MEMORY, REDIS_SPLIT)
+databases = ("sentry",)
+postgres_settings = (POSTGRES_MEMORY, USE_PGBOUNCER, PGBOUNCER_POOL_MODE)
+webserver_files = fingerprint.files("../conf/nginx/*",
+                                    "../conf/uwsgi/sentry.ini")
+webserver_settings = (USE_SUBDOMAINS, USE_SSL, USE_LETSENCRYPT, DOMAIN,
+                      SUBDOMAINS, SSL_CERTIFICATE_PATH,
+                      SSL_CERTIFICATE_KEY_PATH, NGINX_SSL, NGINX_PROXY,
+                      SENTRY_UWSGI,
+                      UWSGI_UNIX_SOCKETS, STATIC_EXPIRES)
+
+
+def full_installation(pool_size=None, force=False):
+    if force:
+        env.force = force
+    Step = scheduler.Step
+    scheduler.run_steps([
+        Step(install_system_packages),
+        Step(probe_disk, after=[install_system_packages], exclusive=True),
+        Step(create_virtualenv, after=[install_system_packages]),
+        Step(install_sentry, after=[create_virtualenv]),
+        Step(upload_configs, after=[install_sentry, probe_disk]),
+        Step(compress_static, after=[install_sentry]),
+        Step(config_sentry, after=[upload_configs]),
+        Step(create_db_user, after=[install_system_packages]),
+        Step(create_db, after=[create_db_user]),
+        Step(config_db, after=[create_db, upload_configs, probe_disk]),
+        Step(config_redis, after=[upload_configs]),
+        Step(sync_db, after=[config_sentry, config_db, config_redis]),
+        Step(config_supervisor, after=[sync_db, upload_configs]),
+        Step(config_webserver, after=[upload_configs]),
+        Step(restart_webserver,
+             after=[config_webserver, sync_db, compress_static]),
+    ], pool_size)
+
+
+@fingerprint.track(system_packages)
 def install_system_packages():
     print("Installing system packages. This could take a few minutes...",
           end="\t")
     try:
-        sudo("apt-add-repository -y ppa:chris-lea/redis-server")
-        sudo("apt-get update")
-        sudo("apt-get -y install %s" % system_packages)
+        key = ("apt", system_packages, artifacts.platform())
+        cached = artifacts.push(key, "/var/cache/apt/archives", use_sudo=True)
+        with batch.Batch() as commands:
+            commands.sudo("apt-add-repository -y ppa:chris-lea/redis-server")
+            commands.sudo("apt-get update")
+            commands.sudo("apt-get -y install %s" % system_packages)
+        if not cached:
+            artifacts.fetch(key, "/var/cache/apt/archives", "*.deb")
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+def probe_disk():
+    print("Measuring the disk IOPS...", end="\t")
+    try:
+        # Measured while no other step loads the disk, the result is kept
+        # on the host for the configuration steps
+        iops = host.disk_iops("/var/tmp")
+        print_succeed()
+        print("  %d IOPS on /var/tmp" % iops)
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(env.dir)
 def create_virtualenv():
     print("Creating virtual environment...", end="\t")
     try:
@@ -93,34 +163,256 @@ def create_virtualenv():
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
 def install_sentry():
     print("Installing sentry. This could take a few minutes...", end="\t")
     try:
-        with virtualenv():
-            run("pip install -U sentry")
-            run("mkdir %s/conf" % env.dir)
-            run("sentry init %s/conf" % env.dir)
+        with virtualenv(), batch.Batch() as commands:
+            commands.run("pip install -U sentry")
+            commands.run("mkdir -p %s/conf" % env.dir)
+            commands.run("sentry init %s/conf" % env.dir)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
+def compress_static():
+    print("Compressing sentry static files...", end="\t")
+    try:
+        run(nginx.precompress(env.sentry_static))
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+def redis_instances():
+    # The cache and TSDB instance, and the instance for the queued data
+    memory = REDIS_MEMORY or host.memory_mb() // 8
+    cache = {
+        'name': "redis-server",
+        'data': "dump",
+        'daemonize': "yes",
+        'port': 6379,
+        'db': 0,
+        'maxmemory': memory,
+        'policy': "allkeys-lru",
+        'save': "save 900 1\nsave 300 1000",
+        'appendonly': "no",
+    }
+    if REDIS_SPLIT == "instance":
+        cache['maxmemory'] = memory // 2
+        queue = dict(cache, name="redis-queue", data="queue", daemonize="no",
+                     port=6380, maxmemory=memory // 2, policy="noeviction",
+                     save="save 300 1", appendonly="yes")
+        return cache, queue
+    # Sharing the instance, only the keys with an expiry can be evicted and
+    # the queued data needs the append only file
+    cache.update({
+        'policy': "volatile-lru",
+        'save': "save 900 1\nsave 300 100",
+        'appendonly': "yes",
+    })
+    return cache, dict(cache, db=1 if REDIS_SPLIT == "db" else 0)
+
+
+def redis_templates():
+    cache, queue = redis_instances()
+    redis = [templates.Template("../conf/redis/redis.conf",
+                                "/etc/redis/redis.conf", context=cache)]
+    if REDIS_SPLIT == "instance":
+        redis += [
+            templates.Template("../conf/redis/redis.conf",
+                               "/etc/redis/redis-queue.conf", context=queue),
+            templates.Template("../conf/supervisor/redis-queue.conf",
+                               "/etc/supervisor/conf.d/redis-queue.conf"),
+        ]
+    return redis
+
+
+def sentry_templates():
+    cache, queue = redis_instances()
+    context = {
+        'cache_port': cache['port'],
+        'cache_db': cache['db'],
+        'queue_port': queue['port'],
+        'queue_db': queue['db'],
+    }
+    context.update(postgres.connection())
+    return [templates.Template(
+        "../conf/sentry/sentry.conf.py",
+        "%s/conf/sentry.conf.py" % env.dir,
+        context=context,
+        use_sudo=False,
+    )]
+
+
+def sentry_queues():
+    with virtualenv():
+        output = run("python -c 'from sentry.conf.server import "
+                     "CELERY_QUEUES; print(\" \".join(sorted("
+                     "queue.name for queue in CELERY_QUEUES)))'",
+                     combine_stderr=False)
+    return output.splitlines()[-1].split()
+
+
+def worker_queues():
+    # The queues of the catch-all worker are read from the installed
+    # release, which adds new ones from time to time
+    dedicated = set(queue for worker in SENTRY_WORKERS
+                    for queue in worker['queues'])
+    rest = [queue for queue in sentry_queues() if queue not in dedicated]
+    return [(worker, worker['queues'] or rest or ["default"])
+            for worker in SENTRY_WORKERS]
+
+
+def worker_maximum(worker):
+    return max(worker['min'], worker['max_per_core'] * host.cores())
+
+
+def sentry_worker_programs():
+    sections = []
+    for worker, queues in worker_queues():
+        maximum = worker_maximum(worker)
+        sections.append(
+            "[program:sentry-worker-%(name)s]\n"
+            "directory=%(dir)s\n"
+            "user=%(user)s\n"
+            "environment=SENTRY_CONF=%(dir)s/conf/sentry.conf.py\n"
+            "command=%(dir)s/bin/sentry celery worker -n %(name)s@%%%%h "
+            "-Q %(queues)s --autoscale=%(max)d,%(min)d\n"
+            "autostart=true\n"
+            "autorestart=true\n"
+            "stopwaitsecs=60\n"
+            "redirect_stderr=true\n"
+            "stdout_logfile=syslog\n"
+            "stderr_logfile=syslog\n" % {
+                'name': worker['name'],
+                'dir': env.dir,
+                'user': env.user,
+                'queues': ",".join(queues),
+                'max': maximum,
+                'min': worker['min'],
+            })
+    return sections
+
+
+def supervisor_templates():
+    return [templates.Template(
+        "../conf/supervisor/sentry.conf",
+        "/etc/supervisor/conf.d/sentry.conf",
+        context={
+            'dir': env.dir,
+            'user': env.user,
+            'workers': "\n".join(sentry_worker_programs()),
+            'programs': ",".join("sentry-worker-" + worker['name']
+                                 for worker in SENTRY_WORKERS),
+        },
+    )]
+
+
+def nginx_site(name, context=None):
+    return templates.Template(
+        "../conf/nginx/" + name,
+        "/etc/nginx/sites-available/" + name,
+        context=context,
+    )
+
+
+def sentry_workers():
+    return uwsgi.workers(SENTRY_UWSGI, process_memory_mb=250, threads=8,
+                         processes_per_core=1)
+
+
+def postgres_clients():
+    # A connection per uwsgi thread and celery process, and celery beat
+    workers = sentry_workers()
+    return (workers['processes'] * workers['threads'] + 1 +
+            sum(worker_maximum(worker) for worker in SENTRY_WORKERS))
+
+env.postgres_clients = postgres_clients
+
+
+def webserver_templates():
+    if USE_SUBDOMAINS:
+        context = {
+            'server_name': SUBDOMAINS['sentry'],
+            'sentry_pass': env.sentry_pass,
+            'static_root': env.sentry_static,
+        }
+        site = "ssl-subdomain-sentry" if USE_SSL else "subdomain-sentry"
+        sites = [nginx_site(site, context)]
+    else:
+        context = {'server_name': DOMAIN}
+        site = "ssl-server" if USE_SSL else "server"
+        sites = [
+            nginx_site("location-sentry", {
+                'sentry_pass': env.sentry_pass,
+                'static_root': env.sentry_static,
+            }),
+            nginx_site(site, context),
+        ]
+    if USE_SSL:
+        context['certificate_path'] = env.ssl_cert_path
+        context['key_path'] = env.ssl_key_path
+        context['ssl_listen'] = nginx.ssl_listen(NGINX_SSL)
+        sites.append(nginx.ssl_params(NGINX_SSL))
+    # The uwsgi protocol can't keep the connections alive
+    keepalive = ""
+    if not UWSGI_UNIX_SOCKETS:
+        keepalive = "keepalive %d;" % NGINX_PROXY['keepalive']
+    return sites + [
+        nginx_site("upstream-sentry", {
+            'server': env.sentry_server,
+            'keepalive': keepalive,
+        }),
+        nginx.proxy_params(NGINX_PROXY),
+        nginx.static_params(STATIC_EXPIRES),
+        templates.Template(
+            "../conf/uwsgi/sentry.ini",
+            "/etc/uwsgi/apps-available/sentry.ini",
+            context=uwsgi.context(
+                sentry_workers(),
+                dir=env.dir,
+                socket=env.socket,
+            ),
+        ),
+    ]
+
+
+def upload_configs():
+    print("Uploading configuration files...", end="\t")
+    try:
+        templates.upload(sentry_templates() + postgres.config_templates() +
+                         redis_templates() + supervisor_templates() +
+                         webserver_templates())
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
+@fingerprint.track(env.dir, sentry_files, redis_settings, postgres_settings)
 def config_sentry():
     print("Configuring sentry...", end="\t")
     try:
-        put("../conf/sentry/sentry.conf.py", "%s/conf/" % env.dir)
+        templates.upload(sentry_templates())
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(postgres.USER, postgres.PASSWORD)
 def create_db_user():
     print("Creating database user...", end="\t")
-    query = "SELECT 1 FROM pg_roles WHERE rolname='dashboard';"
+    query = "SELECT 1 FROM pg_roles WHERE rolname='%s';" % postgres.USER
     try:
-        if not sudo("psql -tAc \""+query+"\"", user="postgres"):
-            sudo("psql -c \"CREATE USER dashboard WITH PASSWORD 'dashboard';\"",
-                 user="postgres")
+        with batch.Batch() as commands:
+            commands.sudo("psql -tAc \""+query+"\" | grep -q 1 || "
+                          "psql -c 'CREATE USER %s;'" % postgres.USER,
+                          user="postgres")
+            # Set again for an existing user, in case the password changed
+            commands.sudo("psql -c \"ALTER USER %s WITH PASSWORD '%s';\"" % (
+                postgres.USER, postgres.PASSWORD), user="postgres")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -128,16 +420,21 @@ def create_db_user():
 
 def db_exists(name):
     query = "SELECT 1 FROM pg_database WHERE datname = '%s';" % name
-    return sudo("psql -tAc \""+query+"\"", user="postgres")
+    return "psql -tAc \""+query+"\" | grep -q 1"
 
 
+@fingerprint.track(databases, postgres.USER)
 def create_db():
     print("Creating database...", end="\t")
     try:
-        if not db_exists("sentry"):
-            sudo("psql -c 'CREATE DATABASE sentry;'", user="postgres")
-        sudo("psql -c 'GRANT ALL PRIVILEGES ON DATABASE sentry TO dashboard;'",
-             user="postgres")
+        with batch.Batch() as commands:
+            for name in databases:
+                commands.sudo(db_exists(name) + " || "
+                              "psql -c 'CREATE DATABASE %s;'" % name,
+                              user="postgres")
+                commands.sudo("psql -c 'GRANT ALL PRIVILEGES ON DATABASE %s "
+                              "TO %s;'" % (name, postgres.USER),
+                              user="postgres")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -146,21 +443,20 @@ def create_db():
 def config_db():
     print("Configuring PostgreSQL...", end="\t")
     try:
-        put("../conf/postgresql/pg_hba.conf", "/etc/postgresql/9.3/main/",
-            use_sudo=True)
-        sudo("service postgresql restart")
+        templates.upload(postgres.config_templates())
+        with batch.Batch() as commands:
+            postgres.configure(commands)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir)
 def sync_db():
     print("Synchronizing database...", end="\t")
     try:
         with virtualenv():
-            output['stdout'] = True
-            run("SENTRY_CONF=%s/conf sentry upgrade" % env.dir)
-            output['stdout'] = False
+            run("SENTRY_CONF=%s/conf sentry upgrade --noinput" % env.dir)
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -171,84 +467,65 @@ def create_user():
         run("SENTRY_CONF=%s/conf sentry createuser" % env.dir)
 
 
+def config_redis():
+    print("Configuring redis...", end="\t")
+    try:
+        redis = redis_templates()
+        templates.upload(redis)
+        restart = templates.changed("redis", redis)
+        with batch.Batch() as commands:
+            if restart:
+                # Redis starts empty if the append only file is enabled on a
+                # dataset that's only on the snapshot, enable it live first
+                for instance in redis_instances():
+                    if instance['appendonly'] == "yes":
+                        commands.sudo("redis-cli -p %d config set appendonly "
+                                      "yes || true" % instance['port'])
+                commands.sudo("service redis-server restart")
+            if REDIS_SPLIT != "instance":
+                commands.sudo("rm -f /etc/supervisor/conf.d/redis-queue.conf")
+            commands.sudo("supervisorctl reread && supervisorctl update")
+            if restart:
+                if REDIS_SPLIT == "instance":
+                    commands.sudo("supervisorctl restart redis-queue")
+                commands.run(restart)
+        print_succeed()
+    except AbortException as e:
+        print_fail(e)
+
+
 def config_supervisor():
-    print("Configuring supervisor for sentry-worker...", end="\t")
+    print("Configuring supervisor for the sentry workers...", end="\t")
     try:
-        files.upload_template(
-            "../conf/supervisor/sentry.conf",
-            "/etc/supervisor/conf.d/",
-            context={'dir': env.dir, 'user': env.user},
-            use_sudo=True,
-        )
-        sudo("service supervisor restart")
+        supervisor = supervisor_templates()
+        templates.upload(supervisor)
+        # The workers also load the sentry configuration
+        restart = templates.changed("supervisor",
+                                    supervisor + sentry_templates())
+        if restart:
+            with batch.Batch() as commands:
+                commands.sudo("service supervisor restart")
+                commands.run(restart)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
+@fingerprint.track(env.dir, webserver_files, webserver_settings)
 def config_webserver():
     if USE_SSL and USE_LETSENCRYPT:
         generate_ssl_certificate()
     print("Configuring webserver...", end="\t")
     try:
-        if USE_SUBDOMAINS:
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-subdomain-sentry",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': SUBDOMAINS['sentry'],
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-subdomain-sentry "
-                     "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/subdomain-sentry",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': SUBDOMAINS['sentry']},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/subdomain-sentry "
-                     "/etc/nginx/sites-enabled/")
-        else:
-            put("../conf/nginx/location-sentry", "/etc/nginx/sites-available/",
-                use_sudo=True)
-            if USE_SSL:
-                files.upload_template(
-                    "../conf/nginx/ssl-server",
-                    "/etc/nginx/sites-available/",
-                    context={
-                        'server_name': DOMAIN,
-                        'certificate_path': env.ssl_cert_path,
-                        'key_path': env.ssl_key_path,
-                    },
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/ssl-server "
-                      "/etc/nginx/sites-enabled/")
-            else:
-                files.upload_template(
-                    "../conf/nginx/server",
-                    "/etc/nginx/sites-available/",
-                    context={'server_name': DOMAIN},
-                    use_sudo=True,
-                )
-                sudo("ln -nsf /etc/nginx/sites-available/server "
-                      "/etc/nginx/sites-enabled/")
-        sudo("rm -f /etc/nginx/sites-enabled/default")
-        files.upload_template(
-            "../conf/uwsgi/sentry.ini",
-            "/etc/uwsgi/apps-available/",
-            context={'dir': env.dir},
-            use_sudo=True,
-        )
-        if not files.exists("/etc/uwsgi/apps-enabled/sentry.ini"):
-            sudo("ln -s /etc/uwsgi/apps-available/sentry.ini "
-                 "/etc/uwsgi/apps-enabled/")
+        webserver = webserver_templates()
+        templates.upload(webserver)
+        with batch.Batch() as commands:
+            for template in webserver:
+                name = os.path.basename(template.remote)
+                if ("-available/" in template.remote and
+                        not name.startswith("location-")):
+                    commands.sudo(templates.enable(template))
+            commands.sudo("rm -f /etc/nginx/sites-enabled/default")
         print_succeed()
     except AbortException as e:
         print_fail(e)
@@ -256,70 +533,73 @@ def config_webserver():
 
 def generate_ssl_certificate():
     print("Generating ssl certificate...", end="\t")
-    if USE_SUBDOMAINS:
-        domain = SUBDOMAINS['sentry']
-        file_prefix = "sentry"
-    else:
-        domain = DOMAIN
-        file_prefix = "cert"
     try:
-        key_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        if not files.exists(key_path, use_sudo=True):
-            if not files.exists("/opt/letsencrypt/"):
-                sudo("git clone https://github.com/letsencrypt/letsencrypt "
-                     "/opt/letsencrypt")
-            sudo("service nginx stop")
-            output['stdout'] = True
-            run("/opt/letsencrypt/letsencrypt-auto certonly --standalone "
-                "--email %(email)s -d %(domain)s" % {
-                    'email': EMAIL, 'domain': domain
-                })
-            output['stdout'] = False
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.ini",
-            "/opt/letsencrypt/"+file_prefix+"-renew.ini",
-            context={'email': EMAIL, 'domain': domain},
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/cert-renew.sh",
-            "/opt/letsencrypt/"+file_prefix+"-renew.sh",
-            context={
-                'renew_conf': file_prefix+"-renew.ini",
-                'domain': domain,
-                'instance_id': INSTANCE_ID,
-                'open_sg': OPEN_SG,
-                'restricted_sg': RESTRICTED_SG,
-            },
-            use_sudo=True,
-        )
-        files.upload_template(
-            "../conf/letsencrypt/crontab",
-            "/opt/letsencrypt/"+file_prefix+"-crontab",
-            context={'renew_script': file_prefix+"-renew.sh"},
-            use_sudo=True,
-        )
-        run("crontab /opt/letsencrypt/"+file_prefix+"-crontab")
-        env.ssl_cert_path = "/etc/letsencrypt/live/%s/fullchain.pem" % domain
-        env.ssl_key_path = "/etc/letsencrypt/live/%s/privkey.pem" % domain
+        if not letsencrypt.exists(env.domain):
+            letsencrypt.issue(env.domain, EMAIL)
+        letsencrypt.install_renewal()
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
-def restart_redis():
-    print("Restarting redis server...", end="\t")
+def restart_webserver():
+    print("Restarting webserver...", end="\t")
     try:
-        sudo("service redis-server restart")
+        webserver = webserver_templates()
+        restart_uwsgi = templates.changed("uwsgi", sentry_templates() + [
+            template for template in webserver
+            if template.remote.startswith("/etc/uwsgi/")])
+        restart_nginx = templates.changed("nginx", [
+            template for template in webserver
+            if not template.remote.startswith("/etc/uwsgi/")])
+        with batch.Batch() as commands:
+            if restart_uwsgi:
+                commands.sudo("service uwsgi restart")
+                commands.run(restart_uwsgi)
+            if restart_nginx:
+                commands.sudo("service nginx restart")
+                commands.run(restart_nginx)
         print_succeed()
     except AbortException as e:
         print_fail(e)
 
 
-def restart_webserver():
-    print("Restarting webserver...", end="\t")
+def benchmark_events(start_rate=10, step=10, max_rate=500, step_duration=30,
+                     clients=16, min_kb=1, max_kb=20):
+    parameters = {
+        'start_rate': int(start_rate),
+        'step': int(step),
+        'max_rate': int(max_rate),
+        'step_duration': int(step_duration),
+        'clients': int(clients),
+        'min_kb': int(min_kb),
+        'max_kb': int(max_kb),
+        'uwsgi': sentry_workers(),
+        'unix_sockets': UWSGI_UNIX_SOCKETS,
+    }
+    # Without the TCP port of uwsgi the events go through nginx
+    url = "http://127.0.0.1:9000"
+    host_header = ""
+    if UWSGI_UNIX_SOCKETS:
+        url = ("https" if USE_SSL else "http") + "://127.0.0.1"
+        host_header = env.domain
+    arguments = ["--%s %d" % (name.replace("_", "-"), parameters[name])
+                 for name in ("start_rate", "step", "max_rate",
+                              "step_duration", "clients", "min_kb", "max_kb")]
+    arguments.append("--url " + url)
+    if host_header:
+        arguments.append("--host-header " + host_header)
+    print("Benchmarking event ingestion. This could take a while...",
+          end="\t")
     try:
-        sudo("service uwsgi restart")
-        sudo("service nginx restart")
+        results = benchmark.run_script(
+            "sentry_load.py", arguments,
+            python="SENTRY_CONF=%(dir)s/conf %(dir)s/bin/python" % {
+                'dir': env.dir})
+        path = benchmark.write_report("events", parameters, results)
+        print_succeed()
+        print("Sustained %s events/s, saturated at %s events/s" % (
+            results['sustained_throughput'], results['saturation_rate']))
+        print("Report written to " + path)
     except AbortException as e:
         print_fail(e)
@@ -5,6 +5,13 @@ USER = 'ubuntu'
 # By default use the ssh configuration at ~/.ssh/config
 SSH_CONFIG = True
 
+# Independent installation steps run at the same time, at most STEPS_POOL_SIZE
+# at once. Set PARALLEL_HOSTS to True to install all the HOSTS at the same
+# time, at most HOSTS_POOL_SIZE at once (0 means no limit)
+STEPS_POOL_SIZE = 4
+PARALLEL_HOSTS = False
+HOSTS_POOL_SIZE = 0
+
 # The environment directories to install graphite and sentry
 GRAPHITE_DIR = "/home/ubuntu/graphite"
 SENTRY_DIR = "/home/ubuntu/sentry"
@@ -14,6 +21,148 @@ JENKINS_DIR = "home/ubuntu/jenkins"
 GRAFANA_DEB = "grafana_2.6.0_amd64.deb"
 GET_GRAFANA = "https://grafanarel.s3.amazonaws.com/builds/"+GRAFANA_DEB
 
+# Grafana admin credentials, also used to provision it through its HTTP API
+GRAFANA_USER = "admin"
+GRAFANA_PASSWORD = "admin"
+
+# Where Grafana keeps the sessions: "postgres" (its own database), "redis"
+# (at GRAFANA_REDIS, e.g. the Redis of Sentry on the same host) or "file"
+GRAFANA_SESSIONS = "postgres"
+GRAFANA_REDIS = "127.0.0.1:6379"
+
+# Number of carbon-cache instances, by default one per CPU core. With more
+# than one, a carbon-relay listens on ports 2003/2004 and shards the metrics
+# between them using consistent hashing
+CARBON_CACHES = 0
+
+# Size the carbon cache and the whisper update and create rates from the
+# host RAM and a quick disk IOPS probe. Set it to False to use the carbon
+# defaults (no cache limit, 500 updates/s and 50 creates/min)
+TUNE_CARBON = True
+
+# Run a carbon-aggregator between statsd and the carbon caches (ports
+# 2023/2024) to compute the cluster-wide sums and averages once at ingest,
+# instead of with wildcard queries. The rules follow the format of
+# aggregation-rules.conf: "output_template (frequency) = method pattern".
+# With AGGREGATOR_FORWARD_ALL disabled only the aggregated metrics are stored
+CARBON_AGGREGATOR = False
+AGGREGATOR_FORWARD_ALL = True
+AGGREGATION_RULES = [
+    "stats.counters.<app>.all.<metric>.count (10) = "
+    "sum stats.counters.<app>.*.<metric>.count",
+    "stats.timers.<app>.all.<metric>.mean (10) = "
+    "avg stats.timers.<app>.*.<metric>.mean",
+]
+
+# Install collectd to send the CPU, memory, disk, network and processes
+# metrics of the host to carbon as collectd.<host>.*, every COLLECTD_INTERVAL
+# seconds to match the collectd retentions of storage-schemas.conf, and add
+# a host saturation dashboard to Grafana
+USE_COLLECTD = True
+COLLECTD_INTERVAL = 10
+COLLECTD_DASHBOARD = True
+
+# Cache graphite-web render results and metric finds (seconds) on a local
+# memcached, sized from the host RAM unless MEMCACHED_MEMORY (MB) is set
+USE_MEMCACHED = True
+MEMCACHED_MEMORY = 0
+GRAPHITE_CACHE_DURATION = 60
+GRAPHITE_FIND_CACHE_DURATION = 300
+
+# Cache graphite render responses on nginx for a short time, so identical
+# requests from many dashboards at once reach graphite-web only once, and
+# gzip the JSON responses
+GRAPHITE_RENDER_CACHE = True
+GRAPHITE_RENDER_CACHE_TTL = "10s"
+GRAPHITE_RENDER_CACHE_SIZE = "256m"
+GRAPHITE_GZIP = True
+
+# The static files of graphite-web and sentry are served by nginx, gzipped at
+# install time, and cached by the browsers for this long
+STATIC_EXPIRES = "30d"
+
+# uwsgi workers of graphite-web and sentry. The processes and threads are
+# computed from the host cores and RAM, set any of these keys to override
+# them: processes, threads, cheaper (minimum processes to keep alive, the
+# rest are spawned on demand), harakiri (seconds before killing a request)
+# and max-requests (requests before recycling a worker)
+GRAPHITE_UWSGI = {}
+SENTRY_UWSGI = {}
+
+# Sentry celery workers, each one run by supervisor and bound to its queues
+# so an error storm doesn't starve the rest, next to a single celery beat
+# process. The autoscale bounds are the minimum processes and the maximum
+# processes per CPU core. The worker without queues consumes every other queue
+# the installed Sentry release declares, so none is left without a consumer
+SENTRY_WORKERS = [
+    {
+        'name': "events",
+        'queues': ["events", "events.preprocess_event",
+                   "events.process_event", "events.save_event"],
+        'min': 2,
+        'max_per_core': 4,
+    },
+    {
+        'name': "notifications",
+        'queues': ["alerts", "digests.delivery", "digests.scheduling",
+                   "email", "reports.deliver", "reports.prepare"],
+        'min': 1,
+        'max_per_core': 1,
+    },
+    {
+        'name': "default",
+        'queues': [],
+        'min': 1,
+        'max_per_core': 2,
+    },
+]
+
+# Memory for PostgreSQL in MB, used to size shared_buffers,
+# effective_cache_size and work_mem. 0 sizes it from the host RAM (half of it)
+POSTGRES_MEMORY = 0
+
+# Put pgbouncer in front of PostgreSQL (port 6432) for graphite, grafana and
+# sentry, so the uwsgi workers share a pool of connections. The pool mode is
+# "session", "transaction" or "statement"
+USE_PGBOUNCER = False
+PGBOUNCER_POOL_MODE = "transaction"
+
+# Memory for the sentry redis in MB, 0 sizes it from the host RAM (an
+# eighth of it)
+REDIS_MEMORY = 0
+
+# Where the celery broker, buffers and digests of sentry are kept, apart
+# from the cache and the TSDB so evictions can't drop queued events:
+# "instance" runs a second redis without evictions, "db" uses another
+# database of the same redis, where only keys with an expiry are evicted,
+# and "" shares everything
+REDIS_SPLIT = "instance"
+
+# Serve graphite-web and sentry on Unix domain sockets instead of TCP
+# loopback ports, with nginx talking the uwsgi protocol to both
+UWSGI_UNIX_SOCKETS = False
+
+# Statsd version (git tag or branch)
+STATSD_VERSION = "v0.7.2"
+
+# Downloaded and built packages (Grafana, Statsd, pip wheels and apt packages)
+# are kept on this local directory and pushed to the hosts, so they're only
+# downloaded or built once. Set it to "" to download them on every host
+ARTIFACT_CACHE = "~/.cache/devops-server"
+
+# Local directory for the JSON reports of the benchmark commands
+BENCHMARK_REPORTS = "../benchmark/reports"
+
+# Send the duration and result of every installation step as statsd metrics
+# (deploy.<component>.<step>.duration) to DEPLOY_STATSD (host:port), by
+# default the statsd of the host being deployed, reached through its SSH
+# connection
+SEND_DEPLOY_TIMINGS = True
+DEPLOY_STATSD = ""
+
+# Local directory for the JSON logs of every installation, "" disables them
+DEPLOY_LOGS = "../deploys"
+
 # Server name (www.example.com)
 DOMAIN = ""
 
@@ -33,3 +182,31 @@ USE_LETSENCRYPT = True
 SSL_CERTIFICATE_PATH = ""
 SSL_CERTIFICATE_KEY_PATH = ""
 EMAIL = ""
+
+# TLS options of the nginx SSL servers: size of the shared session cache ("" to
+# disable it) and timeout, session tickets, HTTP/2 on the 443 listeners
+# (only enabled on nginx 1.9.5 or newer) and OCSP stapling with the given DNS
+# resolvers
+NGINX_SSL = {
+    'session_cache': "10m",
+    'session_timeout': "1h",
+    'session_tickets': False,
+    'http2': True,
+    'stapling': True,
+    'resolver': "8.8.8.8 8.8.4.4",
+}
+
+# Idle keepalive connections every nginx worker keeps open to each backend
+# (Grafana, Jenkins and Sentry), and the buffers of the proxied responses
+NGINX_PROXY = {
+    'keepalive': 16,
+    'buffer_size': "16k",
+    'buffers': "16 16k",
+}
+
+# The Let's Encrypt challenges are answered by nginx on port 80. If it's
+# closed on an EC2 instance, Jenkins opens it with the OPEN_SG security groups
+# while the certificate is issued, and restores RESTRICTED_SG afterwards
+INSTANCE_ID = ""
+OPEN_SG = ""
+RESTRICTED_SG = ""